@@ -1,15 +1,64 @@
+import os
+import sys
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if _COMMON not in sys.path:
+    sys.path.insert(0, _COMMON)
+
+from random_fill import random_choice
 
 class AbelianSandpile:
 
-    def __init__(self, n=100, random_state=None):
+    # Tracer timing sandpile.step and sandpile.wave
+    tracer = None
+    # ResultCache of simulate()
+    cache = None
+
+    def __init__(self, n=100, random_state=None, engine="mask", history="full",
+                 keyframe_interval=1000, memory="default"):
+        """
+        Initialize an AbelianSandpile object.
+
+        Args:
+            n (int): number of rows and columns in the lattice
+            random_state (int): random seed for numpy's random number generator
+            engine (str): toppling engine used by step(). "mask" rebuilds full-lattice
+                masks on every toppling wave, "queue" only visits the frontier of
+                unstable sites. Both give the same grid and the same durations.
+            history (str): "full" keeps a copy of the grid after every step that changes
+                it, "compact" keeps an AvalancheHistory with only the changed sites.
+            keyframe_interval (int): number of events between full-grid keyframes in
+                the compact history
+            memory (str): "default" stores the grid as int64. "lean" stores it as uint8
+                (a site never holds more than 7 grains) and topples in place with
+                preallocated scratch buffers. Both give the same results.
+        """
+        if engine not in ("mask", "queue"):
+            raise ValueError("engine must be 'mask' or 'queue', got {}".format(engine))
+        if history not in ("full", "compact"):
+            raise ValueError("history must be 'full' or 'compact', got {}".format(history))
+        if memory not in ("default", "lean"):
+            raise ValueError("memory must be 'default' or 'lean', got {}".format(memory))
         self.n = n
+        self.engine = engine
+        self.history_mode = history
+        self.memory = memory
         np.random.seed(random_state) # Set the random seed
-        self.grid = np.random.choice([0, 1, 2, 3], size=(n, n))
+        if memory == "lean":
+            self.grid = random_choice([0, 1, 2, 3], np.empty((n, n), dtype=np.uint8))
+        else:
+            self.grid = np.random.choice([0, 1, 2, 3], size=(n, n))
         # self.grid = np.random.choice([3], size=(n, n))
-        self.history =[self.grid.copy()] # Why did we need to copy the grid?
+        if history == "compact":
+            self.history = AvalancheHistory(self.grid, keyframe_interval=keyframe_interval)
+        else:
+            self.history =[self.grid.copy()] # Why did we need to copy the grid?
         self.all_durations = list() # useful to keep track of the duration of toppling events
+        # scratch buffers of the in-place mask engine, allocated on the first toppling
+        self._unstable = None
+        self._received = None
 
     def step(self):
         """
@@ -18,11 +67,38 @@ class AbelianSandpile:
 
         Returns: None
         """
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.clock()
         new_grain_loc = np.random.choice(self.n, size=2)
         self.grid[new_grain_loc[0], new_grain_loc[1]] += 1
+        self._last_drop = new_grain_loc[0] * self.n + new_grain_loc[1]
+        if self.engine == "queue":
+            duration, self._last_toppled = self._topple_queue(self._last_drop)
+        elif self.memory == "lean":
+            duration, self._last_toppled = self._topple_mask_inplace()
+        else:
+            duration, self._last_toppled = self._topple_mask()
+        self.all_durations.append(duration)
+        if tracer is not None:
+            tracer.record("sandpile.step", start)
+
+    def _topple_mask(self):
+        """
+        Topple the whole lattice wave by wave, rebuilding the toppling masks over all
+        n x n sites on every wave.
+
+        Returns:
+            duration (int): number of waves, counted the same way as _topple_queue
+            toppled (np.ndarray): flat index of every toppling, in wave order
+        """
         mask_1 = (self.grid == 4)*1
         duration = 0
+        toppled = [np.zeros(0, dtype=np.intp)]
+        tracer = self.tracer
         while np.sum(mask_1) != 0:
+            if tracer is not None:
+                start = tracer.clock()
             mask_1 = (self.grid >= 4)*1
             mask_history = mask_1.copy().astype(bool)
             row_mask = np.zeros_like(mask_1) + mask_1
@@ -35,8 +111,127 @@ class AbelianSandpile:
             final_mask[mask_history] = 0
             self.grid += final_mask
             self.grid[mask_history] -= 4
+            toppled.append(np.flatnonzero(mask_history))
             duration += 1
-        self.all_durations.append(duration)
+            if tracer is not None:
+                tracer.record("sandpile.wave", start)
+        return duration, np.concatenate(toppled)
+
+    def _topple_mask_inplace(self):
+        """
+        Same waves as _topple_mask, written into two scratch buffers that are allocated
+        once, so no temporary the size of the lattice is created per wave.
+        """
+        grid = self.grid
+        if self._unstable is None:
+            self._unstable = np.zeros(grid.shape, dtype=bool)
+            self._received = np.zeros(grid.shape, dtype=grid.dtype)
+        unstable, received = self._unstable, self._received
+        np.equal(grid, 4, out=unstable)
+        duration = 0
+        toppled = [np.zeros(0, dtype=np.intp)]
+        tracer = self.tracer
+        while unstable.any():
+            if tracer is not None:
+                start = tracer.clock()
+            np.greater_equal(grid, 4, out=unstable)
+            received[...] = 0
+            received[1:] += unstable[:-1]
+            received[:-1] += unstable[1:]
+            received[:, 1:] += unstable[:, :-1]
+            received[:, :-1] += unstable[:, 1:]
+            np.copyto(received, 0, where=unstable)
+            grid += received
+            np.subtract(grid, 4, out=grid, where=unstable)
+            toppled.append(np.flatnonzero(unstable))
+            duration += 1
+            if tracer is not None:
+                tracer.record("sandpile.wave", start)
+        return duration, np.concatenate(toppled)
+
+    def _topple_queue(self, start):
+        """
+        Topple the lattice wave by wave, but only visit the sites that can be unstable.
+        Each wave topples the current frontier (sites holding 4 or more grains) at once,
+        and the next frontier is built from the sites that received grains during the
+        wave. The work per wave is proportional to the frontier, not to n x n.
+
+        Args:
+            start (int or array): flat index (or indices) of the sites to check first
+
+        Returns:
+            duration (int): number of waves. Like the mask engine, this counts the final
+                wave that finds nothing to topple, so it is 0 if nothing toppled and
+                (number of toppling waves + 1) otherwise.
+            toppled (np.ndarray): flat index of every toppling, in wave order
+        """
+        flat = self.grid.reshape(-1) # a view, so writing to flat updates the grid
+        frontier = np.atleast_1d(np.asarray(start, dtype=np.intp))
+        frontier = frontier[flat[frontier] >= 4]
+        duration = 0
+        toppled = [np.zeros(0, dtype=np.intp)]
+        tracer = self.tracer
+        while len(frontier) != 0:
+            if tracer is not None:
+                wave_start = tracer.clock()
+            flat[frontier] -= 4
+            receivers = self._receivers(frontier)
+            np.add.at(flat, receivers, 1)
+            toppled.append(frontier)
+            candidates = np.unique(np.concatenate((frontier, receivers)))
+            frontier = candidates[flat[candidates] >= 4]
+            duration += 1
+            if tracer is not None:
+                tracer.record("sandpile.wave", wave_start)
+        if duration > 0:
+            duration += 1
+        return duration, np.concatenate(toppled)
+
+    def _receivers(self, sites):
+        """
+        Flat indices of the neighbors that receive a grain when each of the given sites
+        topples once. Grains pushed over the edge of the lattice are lost, so those
+        neighbors are dropped.
+        """
+        n = self.n
+        rows, cols = np.divmod(sites, n)
+        return np.concatenate((
+            sites[rows > 0] - n,
+            sites[rows < n - 1] + n,
+            sites[cols > 0] - 1,
+            sites[cols < n - 1] + 1,
+        ))
+
+    def _last_event(self):
+        """
+        Compute the sites changed by the last step and by how much, without comparing
+        full grids. The net change of a site is +1 if the grain was dropped there, +1
+        for every toppling neighbor and -4 for every time the site itself toppled.
+
+        Returns:
+            sites (np.ndarray): sorted flat indices of the sites that changed
+            deltas (np.ndarray): net change of each of those sites
+        """
+        toppled = self._last_toppled
+        receivers = self._receivers(toppled)
+        sites = np.concatenate(([self._last_drop], receivers, toppled))
+        weights = np.concatenate(([1], np.ones(len(receivers)), np.full(len(toppled), -4)))
+        sites, inverse = np.unique(sites, return_inverse=True)
+        deltas = np.rint(np.bincount(inverse, weights=weights)).astype(np.int64)
+        changed = deltas != 0
+        return sites[changed], deltas[changed]
+
+    def bytes_per_cell(self):
+        """
+        Memory held by the grid, the scratch buffers and the history, per lattice site
+        """
+        arrays = [self.grid, self._unstable, self._received]
+        if self.history_mode == "full":
+            arrays += self.history
+        total = sum(a.nbytes for a in arrays if a is not None)
+        if self.history_mode == "compact":
+            total += self.history.nbytes
+        return total / (self.n * self.n)
 
     # we use this decorator for class methods that don't require any of the attributes 
     # stored in self. Notice how we don't pass self to the method
@@ -46,81 +241,453 @@ class AbelianSandpile:
         return np.sum(grid1 != grid2)
 
     
-    def simulate(self, n_step):
+    def simulate(self, n_step, stats=None):
         """
         Simulate the sandpile model for n_step steps.
+
+        With a cache attached, a fresh model (no steps taken yet) loads the grid, the
+        durations and the history of an earlier run that started from the same grid and
+        global random state with the same n_step, engine and history mode. Runs with
+        stats are never cached, since the accumulator needs every event.
+
+        Args:
+            n_step (int): number of grains to add
+            stats (AvalancheStatistics): optional accumulator updated after every event
         """
+        cache = self.cache
+        if cache is not None and (stats is not None or self.all_durations or n_step == 0):
+            cache = None
+        if cache is not None:
+            params = {
+                "n": self.n, "engine": self.engine, "history": self.history_mode,
+                "n_step": n_step, "grid": cache.digest(self.grid.astype(np.uint8)),
+                "rng": cache.rng_digest(),
+            }
+            if self.history_mode == "compact":
+                params["keyframe_interval"] = self.history.keyframe_interval
+            key = cache.key(self, params)
+            result = cache.load(key)
+            if result is not None:
+                self._restore_result(result)
+                cache.restore_rng(result)
+                return self.grid
 
         for i in range(n_step):
             self.step()
-            if self.check_difference(self.grid, self.history[-1]) > 0:
+            if self.history_mode == "compact" or stats is not None:
+                sites, deltas = self._last_event()
+                if len(sites) == 0:
+                    continue
+                if stats is not None:
+                    stats.update(sites, deltas)
+                if self.history_mode == "compact":
+                    self.history.record(
+                        self.grid, sites, deltas, size=len(self._last_toppled),
+                        duration=self.all_durations[-1], step=len(self.all_durations) - 1
+                    )
+                else:
+                    self.history.append(self.grid.copy())
+            elif self.check_difference(self.grid, self.history[-1]) > 0:
                 self.history.append(self.grid.copy())
+        if cache is not None:
+            cache.store(key, dict(self._result_arrays(), **cache.rng_state()))
         return self.grid
 
+    def _result_arrays(self):
+        """The grid, durations and history after simulate(), as arrays to cache"""
+        arrays = {
+            "grid": self.grid.astype(np.uint8),
+            "durations": np.array(self.all_durations, dtype=np.int64),
+            "last_drop": np.array(self._last_drop),
+            "last_toppled": self._last_toppled,
+        }
+        if self.history_mode == "compact":
+            for name, array in self.history.to_arrays().items():
+                arrays["history_" + name] = array
+        else:
+            arrays["history"] = np.array(self.history, dtype=np.uint8)
+        return arrays
+
+    def _restore_result(self, result):
+        """Inverse of _result_arrays"""
+        self.grid[...] = result["grid"]
+        self.all_durations = result["durations"].tolist()
+        self._last_drop = int(result["last_drop"])
+        self._last_toppled = result["last_toppled"]
+        if self.history_mode == "compact":
+            self.history = AvalancheHistory.from_arrays({
+                name[len("history_"):]: array for name, array in result.items()
+                if name.startswith("history_")
+            })
+        else:
+            self.history = list(result["history"].astype(self.grid.dtype))
+
+
+class _GrowableArray:
+    """
+    A flat numpy array with amortized O(1) appends. Capacity doubles when full, so
+    appending N values costs O(N) copies in total.
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, values):
+        values = np.atleast_1d(values)
+        end = self._size + len(values)
+        if end > len(self._data):
+            new_data = np.zeros(max(end, 2 * len(self._data)), dtype=self._data.dtype)
+            new_data[:self._size] = self._data[:self._size]
+            self._data = new_data
+        self._data[self._size:end] = values
+        self._size = end
+
+    def view(self):
+        """Return the filled part of the buffer (no copy)"""
+        return self._data[:self._size]
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+
+class AvalancheHistory:
+    """
+    Compact record of a sandpile run. Instead of a full copy of the grid after every
+    event (a step that changed the grid), this stores the sites each event changed and
+    the signed change at each of them, in flat typed arrays. A full keyframe of the
+    grid is kept every keyframe_interval events, so any snapshot can be rebuilt by
+    replaying at most keyframe_interval events.
+
+    Indexing mirrors the list of snapshots kept by AbelianSandpile(history="full"):
+    history[0] is the initial grid and history[k] is the grid after the k-th event.
+    Event k is the change between history[k] and history[k + 1].
+    """
+
+    def __init__(self, grid, keyframe_interval=1000):
+        """
+        Args:
+            grid (np.ndarray): initial n x n grid
+            keyframe_interval (int): number of events between stored full grids
+        """
+        self.shape = grid.shape
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = [grid.astype(np.uint8)]
+        self._sites = _GrowableArray(np.int32)
+        self._deltas = _GrowableArray(np.int8)
+        self._offsets = _GrowableArray(np.int64)
+        self._offsets.extend(0)
+        self._sizes = _GrowableArray(np.int64)
+        self._durations = _GrowableArray(np.int32)
+        self._steps = _GrowableArray(np.int64)
+
+    def record(self, grid, sites, deltas, size, duration, step):
+        """
+        Append one event.
+
+        Args:
+            grid (np.ndarray): grid after the event, used for keyframes
+            sites (np.ndarray): flat indices of the sites that changed
+            deltas (np.ndarray): net change of each of those sites
+            size (int): number of topplings in the event
+            duration (int): number of toppling waves in the event
+            step (int): index of the step that caused the event
+        """
+        self._sites.extend(sites)
+        self._deltas.extend(deltas)
+        self._offsets.extend(len(self._sites))
+        self._sizes.extend(size)
+        self._durations.extend(duration)
+        self._steps.extend(step)
+        if self.n_events % self.keyframe_interval == 0:
+            self.keyframes.append(grid.astype(np.uint8))
+
+    _columns = ("sites", "deltas", "offsets", "sizes", "durations", "steps")
+
+    def to_arrays(self):
+        """The whole history as a dict of flat arrays, for storing it"""
+        arrays = {name: getattr(self, "_" + name).view() for name in self._columns}
+        arrays["keyframes"] = np.array(self.keyframes)
+        arrays["keyframe_interval"] = np.array(self.keyframe_interval)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild a history from the arrays of to_arrays()"""
+        history = cls(arrays["keyframes"][0], int(arrays["keyframe_interval"]))
+        history.keyframes = list(arrays["keyframes"])
+        for name in cls._columns:
+            column = _GrowableArray(arrays[name].dtype, capacity=max(len(arrays[name]), 1))
+            column.extend(arrays[name])
+            setattr(history, "_" + name, column)
+        return history
+
+    @property
+    def n_events(self):
+        return len(self._sizes)
+
+    @property
+    def nbytes(self):
+        """Memory held by the keyframes and the event buffers"""
+        buffers = (self._sites, self._deltas, self._offsets, self._sizes,
+                   self._durations, self._steps)
+        return sum(k.nbytes for k in self.keyframes) + sum(b.nbytes for b in buffers)
+
+    def __len__(self):
+        return self.n_events + 1
+
+    def __getitem__(self, k):
+        return self.snapshot(k)
+
+    def snapshot(self, k):
+        """
+        Rebuild the grid after the k-th event (k=0 is the initial grid) from the
+        closest earlier keyframe.
+        """
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("snapshot index out of range")
+        keyframe = k // self.keyframe_interval
+        grid = self.keyframes[keyframe].astype(np.int64)
+        offsets = self._offsets.view()
+        start, stop = offsets[keyframe * self.keyframe_interval], offsets[k]
+        np.add.at(grid.reshape(-1), self._sites.view()[start:stop], self._deltas.view()[start:stop])
+        return grid
+
+    def changes(self, k):
+        """Return the (sites, deltas) changed by event k"""
+        offsets = self._offsets.view()
+        start, stop = offsets[k], offsets[k + 1]
+        return self._sites.view()[start:stop], self._deltas.view()[start:stop]
+
+    @property
+    def areas(self):
+        """Number of distinct sites changed by each event"""
+        return np.diff(self._offsets.view())
+
+    @property
+    def sizes(self):
+        """Number of topplings in each event"""
+        return self._sizes.view()
+
+    @property
+    def durations(self):
+        """Number of toppling waves in each event"""
+        return self._durations.view()
+
+    @property
+    def steps(self):
+        """Index of the step that caused each event"""
+        return self._steps.view()
+
+    def activity(self, events, binary=False):
+        """
+        Sum the absolute change of every site over a set of events. This is the
+        compact equivalent of summing np.abs(np.diff(history, axis=0)) over those
+        events.
+
+        Args:
+            events (np.ndarray): indices of the events to include
+            binary (bool): count each changed site once per event instead of adding
+                the size of its change
+
+        Returns:
+            activity (np.ndarray): n x n map of the summed activity
+        """
+        events = np.asarray(events, dtype=np.int64)
+        offsets = self._offsets.view()
+        starts, stops = offsets[events], offsets[events + 1]
+        counts = stops - starts
+        # gather the entries of all the selected events in one pass
+        entries = np.repeat(stops - np.cumsum(counts), counts) + np.arange(np.sum(counts))
+        weights = 1 if binary else np.abs(self._deltas.view()[entries]).astype(np.int64)
+        activity = np.bincount(
+            self._sites.view()[entries],
+            weights=np.broadcast_to(weights, entries.shape),
+            minlength=self.shape[0] * self.shape[1]
+        )
+        return activity.astype(np.int64).reshape(self.shape)
+
+
+class AvalancheStatistics:
+    """
+    Online statistics of the avalanches of a sandpile run, with memory that does not
+    grow with the number of steps. Pass an instance to AbelianSandpile.simulate and it
+    is updated after every event (a step that changed the grid).
+
+    The definitions follow the analysis in this module's __main__ block: the first
+    burn_in events are skipped as transients, an avalanche is an event that changed
+    more than one site, its size is the number of changed sites, and its duration is
+    the number of events since the previous avalanche.
+
+    Statistics from independent runs with the same bins can be combined with merge().
+    """
+
+    def __init__(self, n, burn_in=1000, n_bins=50, max_size=None, max_duration=10**6,
+                 window=50):
+        """
+        Args:
+            n (int): number of rows and columns in the lattice
+            burn_in (int): number of initial events to skip
+            n_bins (int): number of logarithmic bin edges for each histogram
+            max_size (int): upper edge of the size histogram, defaults to n * n
+            max_duration (int): upper edge of the duration histogram
+            window (int): number of most recent avalanches in the activity map
+        """
+        self.n = n
+        self.burn_in = burn_in
+        self.window = window
+        if max_size is None:
+            max_size = n * n
+        self.size_edges = np.logspace(np.log10(2), np.log10(max_size), n_bins)
+        self.duration_edges = np.logspace(np.log10(1), np.log10(max_duration), n_bins)
+        self.size_counts = np.zeros(n_bins - 1, dtype=np.int64)
+        self.duration_counts = np.zeros(n_bins - 1, dtype=np.int64)
+        self.n_events = 0
+        self.n_avalanches = 0
+        self.n_durations = 0
+        self.size_total = 0
+        self.duration_total = 0
+        self._last_avalanche = None
+        # Sliding-window activity map. The sites and changes of the last `window`
+        # avalanches are kept in a ring buffer so the oldest one can be subtracted when
+        # a new one is added.
+        self.activity = np.zeros((n, n), dtype=np.int64)
+        self._ring = [None] * window
+        self._ring_next = 0
+
+    @staticmethod
+    def _add_to_histogram(counts, edges, value):
+        """Add one value to a histogram, with the last bin closed like np.histogram"""
+        i = np.searchsorted(edges, value, side="right") - 1
+        if i == len(counts) and value == edges[-1]:
+            i -= 1
+        if 0 <= i < len(counts):
+            counts[i] += 1
+
+    def update(self, sites, deltas):
+        """
+        Add one event.
+
+        Args:
+            sites (np.ndarray): flat indices of the sites changed by the event
+            deltas (np.ndarray): net change of each of those sites
+        """
+        event = self.n_events
+        self.n_events += 1
+        if len(sites) <= 1:
+            return
+        # the activity map uses every big event, like the __main__ analysis
+        oldest = self._ring[self._ring_next]
+        if oldest is not None:
+            np.subtract.at(self.activity.reshape(-1), oldest[0], oldest[1])
+        changes = np.abs(deltas)
+        np.add.at(self.activity.reshape(-1), sites, changes)
+        self._ring[self._ring_next] = (sites, changes)
+        self._ring_next = (self._ring_next + 1) % self.window
+
+        if event < self.burn_in:
+            return
+        self.n_avalanches += 1
+        self.size_total += len(sites)
+        self._add_to_histogram(self.size_counts, self.size_edges, len(sites))
+        if self._last_avalanche is not None:
+            duration = event - self._last_avalanche
+            self.n_durations += 1
+            self.duration_total += duration
+            self._add_to_histogram(self.duration_counts, self.duration_edges, duration)
+        self._last_avalanche = event
+
+    @property
+    def mean_size(self):
+        return self.size_total / max(self.n_avalanches, 1)
+
+    @property
+    def mean_duration(self):
+        return self.duration_total / max(self.n_durations, 1)
+
+    def merge(self, other):
+        """
+        Combine the statistics of two independent runs. The histograms and counters are
+        added, and the activity map of the result is the sum of the two activity maps.
+        The result is a summary: its ring buffer is empty, so it should not be updated
+        any further.
+        """
+        if not (np.array_equal(self.size_edges, other.size_edges)
+                and np.array_equal(self.duration_edges, other.duration_edges)):
+            raise ValueError("Can only merge statistics with the same histogram bins")
+        merged = AvalancheStatistics(
+            self.n, burn_in=self.burn_in, n_bins=len(self.size_edges),
+            max_size=self.size_edges[-1], max_duration=self.duration_edges[-1],
+            window=self.window
+        )
+        merged.size_edges = self.size_edges
+        merged.duration_edges = self.duration_edges
+        merged.size_counts = self.size_counts + other.size_counts
+        merged.duration_counts = self.duration_counts + other.duration_counts
+        merged.n_events = self.n_events + other.n_events
+        merged.n_avalanches = self.n_avalanches + other.n_avalanches
+        merged.n_durations = self.n_durations + other.n_durations
+        merged.size_total = self.size_total + other.size_total
+        merged.duration_total = self.duration_total + other.duration_total
+        merged.activity = self.activity + other.activity
+        return merged
+
+
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
 # Run sandpile simulation
-    model = AbelianSandpile(n=100, random_state=0)
+    model = AbelianSandpile(n=100, random_state=0, history="compact")
     # model.step()
     plt.figure()
     plt.imshow(model.grid, cmap='gray')
     plt.title("Initial state")
 
-    model.simulate(10000)
+    # the streaming statistics skip the first 1000 events as transients
+    stats = AvalancheStatistics(model.n, burn_in=1000, window=50)
+    model.simulate(10000, stats=stats)
     plt.figure()
     plt.imshow(model.grid, cmap='gray')
     plt.title("Final state")
 
 
-
-
-    # Compute the pairwise difference between all observed snapshots. This command uses list
-    # comprehension, a zip generator, and argument unpacking in order to perform this task
-    # concisely.
-    all_events =  [model.check_difference(*states) for states in zip(model.history[:-1], model.history[1:])]
-    # remove transients before the self-organized critical state is reached
-    all_events = all_events[1000:]
-    # index each timestep by timepoint
-    all_events = list(enumerate(all_events))
-    # remove cases where an avalanche did not occur
-    all_avalanches = [x for x in all_events if x[1] > 1]
-    all_avalanche_times = [item[0] for item in all_avalanches]
-    all_avalanche_sizes= [item[1] for item in all_avalanches]
-    all_avalanche_durations = [event1 - event0 for event0, event1 in zip(all_avalanche_times[:-1], all_avalanche_times[1:])]
-
-
-    log_bins = np.logspace(np.log10(2), np.log10(np.max(all_avalanche_durations)), 50) # logarithmic bins for histogram
-    vals, bins = np.histogram(all_avalanche_durations, bins=log_bins)
+    # The avalanche sizes and durations were binned on logarithmic bins while the model
+    # ran, so there are no per-event lists to post-process here.
     plt.figure()
-    plt.loglog(10**bins[:-1], vals, '.', markersize=10)
+    plt.loglog(stats.duration_edges[:-1], stats.duration_counts, '.', markersize=10)
     plt.title('Avalanche duration distribution')
     plt.xlabel('Avalanche duration')
     plt.ylabel('Count')
 
     ## Visualize activity of the avalanches
-    # Make an array storing all pairwise differences between the lattice at successive
-    # timepoints
-    all_diffs = np.abs(np.diff(np.array(model.history), axis=0))
-    all_diffs[all_diffs > 0] = 1
-    all_diffs = all_diffs[np.sum(all_diffs, axis=(1, 2)) > 1] # Filter to only keep big events
-    most_recent_events = np.sum(all_diffs[-100:], axis=0)
+    # Sum the sites changed by the most recent events, straight from the compact history
+    big_events = np.flatnonzero(model.history.areas > 1) # Filter to only keep big events
+    most_recent_events = model.history.activity(big_events[-100:], binary=True)
     plt.figure(figsize=(5, 5))
     plt.imshow(most_recent_events, cmap='copper')
     plt.title("Avalanch activity in most recent timesteps")
 
-    all_diffs = np.abs(np.diff(np.array(model.history), axis=0))
-    all_diffs = all_diffs[np.sum(all_diffs, axis=(1, 2)) > 1] # Filter to only keep big events
-
-    # Use a trick to calculate the sliding cumulative sum
-    activity_cumulative = np.cumsum(all_diffs, axis=0)
-    activity_sliding = activity_cumulative[50:] - activity_cumulative[:-50]
+    # Sliding-window sum of the activity over 50 big events. Frame j sums the big events
+    # j+1 ... j+50, and we only build the last 500 frames.
+    window = 50
+    last_frames = range(max(len(big_events) - window - 500, 0), len(big_events) - window)
+    activity_sliding2 = np.array(
+        [model.history.activity(big_events[j + 1:j + 1 + window]) for j in last_frames]
+    )
 
     plt.figure(figsize=(5, 5))
-    plt.imshow(activity_sliding[-1], cmap='copper')
+    plt.imshow(stats.activity, cmap='copper')
     plt.title("Cumulative activity in most recent timesteps")
-    activity_sliding2 = activity_sliding[-500:]
     vmin = np.percentile(activity_sliding2, 1)
     # vmin = 0
     vmax = np.percentile(activity_sliding2, 99.8)
+    os.makedirs("cphy/hw/private_dump/sandpile", exist_ok=True)
     for i in range(len(activity_sliding2) - 1):
         
         
@@ -0,0 +1,149 @@
+import time
+
+import numpy as np
+
+from abelian_sandpile import AbelianSandpile
+
+
+class BatchedSandpile:
+    """
+    Many independent replicas of the sandpile model, stored as one (R, n, n) array.
+    Every step drops one grain into each replica and topples all of them together
+    with vectorized waves, until every replica is stable again.
+
+    Each replica draws its grain locations from its own np.random.Generator. The
+    generators are spawned from one SeedSequence, so the replicas are independent and
+    a run is reproducible from a single random_state.
+    """
+
+    # number of grain locations drawn from each generator at a time
+    _block_size = 1024
+
+    def __init__(self, n=100, n_replicas=10, random_state=None):
+        """
+        Initialize a BatchedSandpile object.
+
+        Args:
+            n (int): number of rows and columns in each lattice
+            n_replicas (int): number of independent replicas
+            random_state (int): seed of the SeedSequence the replica streams are
+                spawned from
+        """
+        self.n = n
+        self.n_replicas = n_replicas
+        seeds = np.random.SeedSequence(random_state).spawn(n_replicas)
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+        self.grid = np.stack([rng.integers(0, 4, size=(n, n)) for rng in self.rngs])
+        self.all_durations = list() # one array with the duration of every replica per step
+        self._drops = np.zeros((n_replicas, 0, 2), dtype=np.int64)
+        self._next_drop = 0
+
+    def _draw_drops(self):
+        """Return the next grain location of every replica, as an (R, 2) array"""
+        if self._next_drop == self._drops.shape[1]:
+            self._drops = np.stack(
+                [rng.integers(self.n, size=(self._block_size, 2)) for rng in self.rngs]
+            )
+            self._next_drop = 0
+        drops = self._drops[:, self._next_drop]
+        self._next_drop += 1
+        return drops
+
+    def step(self):
+        """
+        Add one grain to every replica and topple until all of them are stable.
+
+        Returns: None
+        """
+        drops = self._draw_drops()
+        replicas = np.arange(self.n_replicas)
+        self.grid[replicas, drops[:, 0], drops[:, 1]] += 1
+        # only the replicas whose new grain made a site unstable need to topple
+        active = replicas[self.grid[replicas, drops[:, 0], drops[:, 1]] >= 4]
+        self.all_durations.append(self._topple(active))
+
+    def _topple(self, active):
+        """
+        Topple the given replicas with synchronous waves. Replicas leave the batch as
+        soon as they are stable, so late waves only touch the replicas still avalanching.
+
+        Args:
+            active (np.ndarray): indices of the replicas that have an unstable site
+
+        Returns:
+            durations (np.ndarray): number of waves of every replica, counted like
+                AbelianSandpile.step (0 if nothing toppled, waves + 1 otherwise)
+        """
+        durations = np.zeros(self.n_replicas, dtype=np.int64)
+        sub = self.grid[active]
+        waves = np.zeros(len(active), dtype=np.int64)
+        while len(active) != 0:
+            unstable = sub >= 4
+            going = unstable.any(axis=(1, 2))
+            if not going.all():
+                done = ~going
+                self.grid[active[done]] = sub[done]
+                durations[active[done]] = waves[done] + 1
+                active, sub = active[going], sub[going]
+                unstable, waves = unstable[going], waves[going]
+                if len(active) == 0:
+                    break
+            # grains pushed over the edge of a lattice are lost
+            sub -= 4 * unstable
+            sub[:, 1:, :] += unstable[:, :-1, :]
+            sub[:, :-1, :] += unstable[:, 1:, :]
+            sub[:, :, 1:] += unstable[:, :, :-1]
+            sub[:, :, :-1] += unstable[:, :, 1:]
+            waves += 1
+        return durations
+
+    @property
+    def durations(self):
+        """Durations as a (steps, R) array"""
+        return np.array(self.all_durations).reshape(-1, self.n_replicas)
+
+    def simulate(self, n_step):
+        """
+        Simulate all replicas for n_step steps.
+        """
+        for i in range(n_step):
+            self.step()
+        return self.grid
+
+
+def benchmark(n=64, n_replicas=32, n_step=2000, random_state=0):
+    """
+    Compare the throughput of BatchedSandpile against running the same number of
+    AbelianSandpile replicas one after another.
+
+    Returns:
+        results (dict): grains added per second for both, and the speedup
+    """
+    start = time.perf_counter()
+    for replica in range(n_replicas):
+        model = AbelianSandpile(n=n, random_state=replica)
+        for i in range(n_step):
+            model.step()
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    BatchedSandpile(n=n, n_replicas=n_replicas, random_state=random_state).simulate(n_step)
+    batch_time = time.perf_counter() - start
+
+    n_grains = n_replicas * n_step
+    return {
+        "single_grains_per_s": n_grains / single_time,
+        "batch_grains_per_s": n_grains / batch_time,
+        "speedup": single_time / batch_time,
+    }
+
+
+if __name__ == "__main__":
+    for n_replicas in (1, 8, 32, 128):
+        results = benchmark(n=64, n_replicas=n_replicas, n_step=1000)
+        print(
+            "R = {:4d}: single {:10.0f} grains/s, batched {:10.0f} grains/s, speedup {:.1f}x".format(
+                n_replicas, results["single_grains_per_s"], results["batch_grains_per_s"],
+                results["speedup"]
+            ), flush=True
+        )
@@ -0,0 +1,256 @@
+"""
+Domain-decomposed sandpile for very large lattices.
+
+The lattice lives in shared memory and is split into horizontal strips, one per worker
+process. A worker topples its own strip until it is stable, and the grains it pushes
+over the top or bottom edge of the strip are collected in halo buffers. The workers then
+meet at a barrier, add the grains their neighbours sent them, and start again, until a
+round in which no strip received grains that made it unstable.
+
+Because the model is abelian, the order of the topplings does not change the final
+stable configuration, so the result is the same as toppling the whole lattice in one
+process.
+"""
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+from threading import BrokenBarrierError
+
+import numpy as np
+
+from abelian_sandpile import AbelianSandpile
+
+
+def _relax(strip, lo, hi, out_up, out_down):
+    """
+    Topple a strip until it is stable. Every unstable site topples h // 4 times at once.
+
+    Only the rows lo .. hi-1 can be unstable at the start. Topplings can only make the
+    rows next to them unstable, so the window grows by a row on each side per sweep and
+    shrinks to the rows that are actually unstable.
+
+    Args:
+        strip (np.ndarray): rows of the lattice owned by the worker
+        lo, hi (int): window of rows that may be unstable
+        out_up, out_down (np.ndarray): grains pushed over the top and bottom edge of
+            the strip are added to these
+
+    Returns:
+        topplings (int): number of topplings
+    """
+    rows = strip.shape[0]
+    topplings = 0
+    while lo < hi:
+        t = strip[lo:hi] >> 2
+        active = np.flatnonzero(t.any(axis=1))
+        if len(active) == 0:
+            break
+        lo, hi = lo + active[0], lo + active[-1] + 1
+        t = t[active[0]:active[-1] + 1]
+        topplings += int(t.sum())
+
+        strip[lo:hi] &= 3 # h - 4 * (h // 4)
+        strip[lo:hi, 1:] += t[:, :-1]
+        strip[lo:hi, :-1] += t[:, 1:]
+        # to the row below
+        end = min(hi + 1, rows)
+        strip[lo+1:end] += t[:end - lo - 1]
+        if hi == rows:
+            out_down += t[-1]
+        # to the row above
+        start = max(lo - 1, 0)
+        strip[start:hi-1] += t[start - lo + 1:]
+        if lo == 0:
+            out_up += t[0]
+        lo, hi = start, end
+    return topplings
+
+
+def _worker(index, n_workers, bounds, grid_name, aux_name, shape, dtype, barrier,
+            commands, results):
+    """
+    Worker process owning the rows bounds[index] .. bounds[index+1]-1 of the lattice.
+
+    Every round of a stabilization:
+        1. relax the strip, collecting the outgoing grains in its halo buffers
+        2. barrier
+        3. add the grains from the neighbours' halo buffers, and flag the strip as
+           active if they made it unstable
+        4. barrier
+        5. clear its own halo buffers, and stop if no strip is active
+    The buffers a worker reads in 3 are only cleared by their owner in 5, after the
+    second barrier, and the flags read in 5 are only written again in 3 of the next
+    round, after every worker passed the first barrier of that round.
+    """
+    grid_shm = shared_memory.SharedMemory(name=grid_name)
+    aux_shm = shared_memory.SharedMemory(name=aux_name)
+    try:
+        grid = np.ndarray(shape, dtype=dtype, buffer=grid_shm.buf)
+        # halo[w, 0] is sent up by worker w, halo[w, 1] down; then one flag per worker
+        halo = np.ndarray((n_workers, 2, shape[1]), dtype=dtype, buffer=aux_shm.buf)
+        active = np.ndarray(n_workers, dtype=np.int8, buffer=aux_shm.buf,
+                            offset=halo.nbytes)
+        strip = grid[bounds[index]:bounds[index + 1]]
+        rows = strip.shape[0]
+        out_up, out_down = halo[index, 0], halo[index, 1]
+
+        while commands.get() == "stabilize":
+            try:
+                topplings, rounds = 0, 0
+                lo, hi = 0, rows
+                while True:
+                    topplings += _relax(strip, lo, hi, out_up, out_down)
+                    rounds += 1
+                    barrier.wait()
+                    if index > 0:
+                        strip[0] += halo[index - 1, 1]
+                    if index < n_workers - 1:
+                        strip[-1] += halo[index + 1, 0]
+                    top, bottom = (strip[0] >= 4).any(), (strip[-1] >= 4).any()
+                    active[index] = top or bottom
+                    barrier.wait()
+                    out_up[:] = 0
+                    out_down[:] = 0
+                    if not active.any():
+                        break
+                    # only the edge rows got grains, so only they can be unstable
+                    lo = 0 if top else rows - 1
+                    hi = rows if bottom else 1
+                results.put((index, topplings, rounds))
+            except Exception as error:
+                barrier.abort()
+                results.put((index, error, 0))
+    finally:
+        grid_shm.close()
+        aux_shm.close()
+
+
+class ParallelSandpile:
+    """
+    Sandpile lattice in shared memory, relaxed by a pool of worker processes that each
+    own a strip of rows. Use it as a context manager, or call close(), to stop the
+    workers and free the shared memory.
+    """
+
+    def __init__(self, n=100, n_workers=4, random_state=None, grid=None):
+        """
+        Initialize a ParallelSandpile object.
+
+        Args:
+            n (int): number of rows and columns in the lattice
+            n_workers (int): number of worker processes, at most n
+            random_state (int): random seed for numpy's random number generator. The
+                random grid is drawn like AbelianSandpile's.
+            grid (np.ndarray): optional starting grid of grain counts, overrides n
+        """
+        if grid is None:
+            np.random.seed(random_state) # Set the random seed
+            grid = np.random.choice([0, 1, 2, 3], size=(n, n))
+        grid = np.asarray(grid, dtype=np.int64)
+        self.n = grid.shape[0]
+        self.n_workers = min(n_workers, grid.shape[0])
+        self.bounds = np.linspace(0, grid.shape[0], self.n_workers + 1).astype(int)
+
+        self._grid_shm = shared_memory.SharedMemory(create=True, size=grid.nbytes)
+        aux_size = self.n_workers * 2 * grid.shape[1] * grid.itemsize + self.n_workers
+        self._aux_shm = shared_memory.SharedMemory(create=True, size=aux_size)
+        self.grid = np.ndarray(grid.shape, dtype=grid.dtype, buffer=self._grid_shm.buf)
+        self.grid[...] = grid
+        np.ndarray(aux_size, dtype=np.uint8, buffer=self._aux_shm.buf)[:] = 0
+
+        self._barrier = mp.Barrier(self.n_workers)
+        self._commands = [mp.Queue() for w in range(self.n_workers)]
+        self._results = mp.Queue()
+        self._workers = [
+            mp.Process(
+                target=_worker,
+                args=(w, self.n_workers, self.bounds, self._grid_shm.name,
+                      self._aux_shm.name, grid.shape, grid.dtype, self._barrier,
+                      self._commands[w], self._results),
+                daemon=True,
+            )
+            for w in range(self.n_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        self.all_topplings = list()
+
+    def stabilize(self):
+        """
+        Topple the lattice until every site holds fewer than 4 grains.
+
+        Returns:
+            topplings (int): total number of topplings
+        """
+        for commands in self._commands:
+            commands.put("stabilize")
+        replies = [self._results.get() for w in range(self.n_workers)]
+        errors = [r[1] for r in replies if isinstance(r[1], Exception)]
+        if errors:
+            broken = [e for e in errors if not isinstance(e, BrokenBarrierError)]
+            raise (broken or errors)[0]
+        topplings = sum(r[1] for r in replies)
+        self.all_topplings.append(topplings)
+        return topplings
+
+    def add(self, rows, cols, grains=1):
+        """Add grains at the given sites, without toppling"""
+        np.add.at(self.grid, (rows, cols), grains)
+
+    def drop(self, n_grains):
+        """
+        Drop n_grains grains at random sites, drawn with numpy's global random state,
+        and stabilize. The result is the same as dropping them one by one with
+        AbelianSandpile.step, since the order of additions and topplings does not matter.
+
+        Returns:
+            topplings (int): total number of topplings
+        """
+        sites = np.random.randint(self.n, size=(n_grains, 2))
+        self.add(sites[:, 0], sites[:, 1])
+        return self.stabilize()
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        if self._workers is None:
+            return
+        for commands in self._commands:
+            commands.put("stop")
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+        self.grid = self.grid.copy() # keep the final grid after the memory is freed
+        self._grid_shm.close()
+        self._grid_shm.unlink()
+        self._aux_shm.close()
+        self._aux_shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    # compare against toppling the same bulk-loaded lattice in a single process
+    n = 1024
+    np.random.seed(0)
+    loaded = np.random.randint(0, 5, size=(n, n))
+
+    model = AbelianSandpile(n=n, engine="queue")
+    model.grid = loaded.copy()
+    start = time.perf_counter()
+    model._topple_queue(np.flatnonzero(model.grid >= 4))
+    print("single process: {:.2f} s".format(time.perf_counter() - start))
+
+    for n_workers in (1, 2, 4):
+        with ParallelSandpile(n_workers=n_workers, grid=loaded) as pile:
+            start = time.perf_counter()
+            topplings = pile.stabilize()
+            elapsed = time.perf_counter() - start
+            same = np.array_equal(pile.grid, model.grid)
+        print("{} workers: {:.2f} s, {} topplings, same grid as single process: {}".format(
+            n_workers, elapsed, topplings, same
+        ))
+        assert same
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from abelian_sandpile import AbelianSandpile
+from parallel_sandpile import ParallelSandpile
+from sandpile_group import stabilize
+
+
+@pytest.mark.parametrize("n, n_workers", [
+    (8, 1), (8, 2), (17, 3), (32, 4), (33, 5),
+    (6, 6), # n_workers == n, every strip is one row
+    (4, 10), # more workers than rows
+])
+def test_stabilize_matches_single_process(n, n_workers):
+    np.random.seed(n)
+    loaded = np.random.randint(0, 12, size=(n, n))
+    stable, odometer = stabilize(loaded, return_odometer=True)
+    with ParallelSandpile(n_workers=n_workers, grid=loaded) as pile:
+        topplings = pile.stabilize()
+        assert pile.n_workers == min(n_workers, n)
+        assert np.array_equal(pile.grid, stable)
+    assert topplings == odometer.sum()
+
+
+def test_one_row_strips_on_rectangular_lattice():
+    np.random.seed(0)
+    loaded = np.random.randint(0, 20, size=(5, 23))
+    with ParallelSandpile(n_workers=5, grid=loaded) as pile:
+        pile.stabilize()
+        assert np.array_equal(pile.grid, stabilize(loaded))
+
+
+def test_stabilize_twice_after_adding_grains():
+    np.random.seed(1)
+    loaded = np.random.randint(0, 8, size=(16, 16))
+    with ParallelSandpile(n_workers=4, grid=loaded) as pile:
+        pile.stabilize()
+        pile.add(np.array([0, 7, 8, 15]), np.array([3, 7, 8, 15]), grains=9)
+        pile.stabilize()
+        grid = pile.grid.copy()
+    loaded[[0, 7, 8, 15], [3, 7, 8, 15]] += 9
+    assert np.array_equal(grid, stabilize(loaded))
+
+
+@pytest.mark.parametrize("n, n_workers", [(10, 1), (10, 3), (12, 12)])
+def test_drop_matches_grain_by_grain_steps(n, n_workers):
+    n_grains = 300
+    # the constructors seed the global random state, so the models run one at a time
+    model = AbelianSandpile(n=n, random_state=7, engine="queue")
+    topplings = 0
+    for i in range(n_grains):
+        model.step()
+        topplings += len(model._last_toppled)
+
+    with ParallelSandpile(n=n, n_workers=n_workers, random_state=7) as pile:
+        assert pile.drop(n_grains) == topplings
+        assert np.array_equal(pile.grid, model.grid)
@@ -0,0 +1,108 @@
+"""
+Memory footprint of the lattice models in their default and lean memory modes.
+
+Every model is built with memory="default" and memory="lean", run for a few steps so
+the engine allocates its scratch buffers, and asked for its bytes_per_cell(). The
+report also gives the largest square lattice that fits in a RAM budget.
+
+Example:
+    python benchmarks/bench_memory.py --n 512 --ram-gb 16 --target 16384
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("abelian_sandpile", "percolation", "game_of_life", "river_evolution"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+from abelian_sandpile import AbelianSandpile
+from main import Game_of_Life
+from percolation import PercolationSimulation
+from river_evolution import River_Evolution
+
+
+def build_sandpile(n, engine, memory):
+    model = AbelianSandpile(n=n, random_state=0, engine=engine, history="compact",
+                            memory=memory)
+    model.simulate(100)
+    return model
+
+
+def build_percolation(n, engine, memory):
+    model = PercolationSimulation(n=n, p=0.4, random_state=0, engine=engine, memory=memory)
+    model.percolate()
+    return model
+
+
+def build_game_of_life(n, engine, memory):
+    model = Game_of_Life(n=n, random_state=0, engine=engine, memory=memory)
+    for i in range(3):
+        model.step()
+    return model
+
+
+def build_river(n, engine, memory):
+    np.random.seed(0)
+    model = River_Evolution(n=n, m=n, engine=engine, memory=memory)
+    model.run(100)
+    return model
+
+
+# (model, builder, engine)
+CASES = [
+    ("sandpile", build_sandpile, "mask"),
+    ("sandpile", build_sandpile, "queue"),
+    ("percolation", build_percolation, "flow"),
+    ("game_of_life", build_game_of_life, "vectorized"),
+    ("game_of_life", build_game_of_life, "bitpacked"),
+    ("river", build_river, "synchronous"),
+    ("river", build_river, "event"),
+]
+
+
+def footprint(n=256, ram_bytes=16e9):
+    """
+    Returns:
+        rows (list): one dict per case and memory mode with the "model", "engine",
+            "memory", "bytes_per_cell" and the side "max_n" of the largest square
+            lattice that fits in ram_bytes
+    """
+    rows = list()
+    for model, build, engine in CASES:
+        for memory in ("default", "lean"):
+            bytes_per_cell = build(n, engine, memory).bytes_per_cell()
+            rows.append({
+                "model": model,
+                "engine": engine,
+                "memory": memory,
+                "bytes_per_cell": bytes_per_cell,
+                "max_n": int(np.sqrt(ram_bytes / bytes_per_cell)),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per cell of the lattice models")
+    parser.add_argument("--n", type=int, default=256, help="lattice size measured")
+    parser.add_argument("--ram-gb", type=float, default=16, help="RAM budget")
+    parser.add_argument("--target", type=int, default=16384,
+                        help="lattice size to check against the budget")
+    args = parser.parse_args()
+
+    ram_bytes = args.ram_gb * 1e9
+    print("{:<13s} {:<12s} {:<8s} {:>10s} {:>10s} {:>12s}".format(
+        "model", "engine", "memory", "B/cell", "max n", "{}^2 GB".format(args.target)
+    ))
+    for row in footprint(args.n, ram_bytes):
+        needed = row["bytes_per_cell"] * args.target ** 2
+        print("{:<13s} {:<12s} {:<8s} {:>10.2f} {:>10d} {:>9.1f}{}".format(
+            row["model"], row["engine"], row["memory"], row["bytes_per_cell"],
+            row["max_n"], needed / 1e9, "" if needed <= ram_bytes else "  too big"
+        ))
+
+
+if __name__ == "__main__":
+    main()
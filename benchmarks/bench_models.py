@@ -0,0 +1,286 @@
+"""
+Benchmark suite for the lattice models.
+
+Every case runs one model with one engine over a range of lattice sizes with a fixed
+seed, and reports the best time per step over a few repeats, the updates per second,
+the peak memory allocated during the run (measured with tracemalloc in a separate,
+untimed run) and the scaling exponent of the time per step against n. Results are
+written as JSON, and a run can be compared against an earlier one to flag slowdowns.
+
+The models are built outside the timed region. An update is the unit of work the
+engine actually does: a toppling of the sandpile, a site of a percolation lattice, a
+cell of a Game of Life generation, and a unit of water moved by the random river
+engine, a relaxation of the event engine or a cell of the synchronous engine.
+
+Example:
+    python benchmarks/bench_models.py --out new.json --compare old.json --threshold 0.2
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("abelian_sandpile", "percolation", "game_of_life", "river_evolution"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+from abelian_sandpile import AbelianSandpile
+from main import Game_of_Life
+from percolation import PercolationSimulation
+from river_evolution import River_Evolution
+from sandpile_group import stabilize
+
+# every model has a build_* function, which is not timed, and a run_* function, which
+# is timed and returns the number of updates it did
+
+
+def build_sandpile(n, n_step, engine, seed):
+    model = AbelianSandpile(n=n, random_state=seed, engine=engine, history="compact")
+    # the random 0-3 lattice is far below the critical density, where avalanches stay
+    # small. 3 more grains on every site, stabilized, give a recurrent configuration,
+    # which is where the driven pile stays once it is critical.
+    model.grid = stabilize(model.grid + 3).astype(model.grid.dtype)
+    return model
+
+
+def run_sandpile(model, n_step):
+    topplings = 0
+    for i in range(n_step):
+        model.step()
+        topplings += len(model._last_toppled)
+    return topplings
+
+
+def build_percolation(n, n_step, engine, seed):
+    # one step is one lattice filled from the top
+    return [PercolationSimulation(n=n, p=0.4, random_state=seed + i, engine=engine)
+            for i in range(n_step)]
+
+
+def run_percolation(models, n_step):
+    for model in models:
+        model.percolate()
+    return sum(model.n * model.n for model in models)
+
+
+def build_game_of_life(n, n_step, engine, seed):
+    return Game_of_Life(n=n, random_state=seed, engine=engine)
+
+
+def run_game_of_life(model, n_step):
+    for i in range(n_step):
+        model.step()
+    return model.grid.size * n_step
+
+
+def build_river(n, n_step, engine, seed):
+    np.random.seed(seed)
+    return River_Evolution(n=n, m=n, random_state=seed, engine=engine)
+
+
+def run_river(model, n_step):
+    moved = model.flux[0].sum()
+    model.run(n_step)
+    if model.engine == "event":
+        return model.n_relaxations
+    if model.engine == "synchronous":
+        return model.n * model.m * n_step
+    return int(model.flux[0].sum() - moved)
+
+
+# model -> (build, run)
+MODELS = {
+    "sandpile": (build_sandpile, run_sandpile),
+    "percolation": (build_percolation, run_percolation),
+    "game_of_life": (build_game_of_life, run_game_of_life),
+    "river": (build_river, run_river),
+}
+
+# (model, engine, sizes, steps per run)
+CASES = [
+    ("sandpile", "queue", [32, 64, 128], 2000),
+    ("sandpile", "mask", [32, 64, 128], 500),
+    ("percolation", "flow", [32, 64, 128], 10),
+    ("percolation", "union_find", [32, 64, 128], 10),
+    ("game_of_life", "python", [16, 32, 64], 5),
+    ("game_of_life", "vectorized", [128, 256, 512], 50),
+    ("game_of_life", "bitpacked", [128, 256, 512], 50),
+    ("game_of_life", "sparse", [128, 256, 512], 50),
+    ("river", "random", [32, 64, 128], 2000),
+    ("river", "synchronous", [64, 128, 256], 500),
+    ("river", "event", [64, 128, 256], 5000),
+]
+
+
+def measure(model, engine, n, n_step, seed=0, memory=True, repeats=3):
+    """
+    Run one case and measure it. The time is the best of repeats identical runs, which
+    is less sensitive to other load on the machine than the mean. Every run starts
+    from a freshly built model, and only the steps are timed.
+
+    Returns:
+        result (dict): the case, "seconds", "time_per_step", "updates" (see the
+            module docstring), "updates_per_s" and "peak_bytes" of building and
+            running the model (None if memory is False)
+    """
+    build, run = MODELS[model]
+    seconds = np.inf
+    for k in range(repeats):
+        state = build(n, n_step, engine, seed)
+        start = time.perf_counter()
+        updates = run(state, n_step)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        # tracemalloc slows Python code down, so memory gets its own run
+        tracemalloc.start()
+        run(build(n, n_step, engine, seed), n_step)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "model": model,
+        "engine": engine,
+        "n": n,
+        "n_step": n_step,
+        "seconds": seconds,
+        "time_per_step": seconds / n_step,
+        "updates": int(updates),
+        "updates_per_s": updates / seconds,
+        "peak_bytes": peak,
+    }
+
+
+def scaling_exponents(results):
+    """
+    Fit time_per_step ~ n^alpha for every (model, engine).
+
+    Returns:
+        exponents (dict): alpha keyed by "model/engine"
+    """
+    exponents = dict()
+    for model, engine in sorted({(r["model"], r["engine"]) for r in results}):
+        rows = [r for r in results if r["model"] == model and r["engine"] == engine]
+        if len(rows) < 2:
+            continue
+        n = np.log([r["n"] for r in rows])
+        t = np.log([r["time_per_step"] for r in rows])
+        alpha, intercept = np.polyfit(n, t, 1)
+        exponents[model + "/" + engine] = float(alpha)
+    return exponents
+
+
+def run_suite(cases=CASES, seed=0, memory=True, scale=1.0, repeats=3):
+    """
+    Run every case and collect the results.
+
+    Args:
+        cases (list): (model, engine, sizes, n_step) tuples
+        seed (int): random seed of every run
+        memory (bool): also measure peak memory
+        scale (float): multiplies the number of steps of every case
+        repeats (int): number of timed runs per case
+
+    Returns:
+        report (dict): "meta" data about the machine, the "results" of every run and
+            the fitted "scaling" exponents
+    """
+    results = list()
+    for model, engine, sizes, n_step in cases:
+        for n in sizes:
+            result = measure(model, engine, n, max(1, int(n_step * scale)), seed, memory,
+                             repeats)
+            results.append(result)
+            print(format_result(result), flush=True)
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.platform(),
+            "seed": seed,
+            "repeats": repeats,
+        },
+        "results": results,
+        "scaling": scaling_exponents(results),
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Compare the time per step of two reports, matching runs by model, engine, n and
+    number of steps.
+
+    Returns:
+        rows (list): (model, engine, n, baseline time per step, current time per step,
+            ratio, regressed) for every run found in both reports. A run regressed if
+            it got slower by more than the threshold fraction.
+    """
+    def key(r):
+        return r["model"], r["engine"], r["n"], r["n_step"]
+
+    old = {key(r): r for r in baseline["results"]}
+    rows = list()
+    for r in current["results"]:
+        if key(r) not in old:
+            continue
+        before, after = old[key(r)]["time_per_step"], r["time_per_step"]
+        ratio = after / before
+        rows.append((r["model"], r["engine"], r["n"], before, after, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def format_result(r):
+    peak = "-" if r["peak_bytes"] is None else "{:.1f} MB".format(r["peak_bytes"] / 1e6)
+    return "{:<13s} {:<11s} n = {:5d}  {:10.3e} s/step  {:10.3e} updates/s  peak {}".format(
+        r["model"], r["engine"], r["n"], r["time_per_step"], r["updates_per_s"], peak
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lattice models")
+    parser.add_argument("--out", default="benchmark.json", help="JSON file of results")
+    parser.add_argument("--compare", default=None, help="earlier JSON file to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown fraction flagged as a regression")
+    parser.add_argument("--models", nargs="+", default=None, choices=sorted(MODELS),
+                        help="only benchmark these models")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the number of steps of every case")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory runs")
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if args.models is None or case[0] in args.models]
+    report = run_suite(cases, args.seed, not args.no_memory, args.scale,
+                       args.repeats)
+    print()
+    for name, alpha in report["scaling"].items():
+        print("{:<26s} time per step ~ n^{:.2f}".format(name, alpha))
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, report, args.threshold)
+        print()
+        for model, engine, n, before, after, ratio, regressed in rows:
+            print("{:<13s} {:<11s} n = {:5d}  {:10.3e} -> {:10.3e} s/step  x{:.2f}{}".format(
+                model, engine, n, before, after, ratio, "  REGRESSION" if regressed else ""
+            ))
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Startup cost of the model modules.
+
+Every module is imported in a fresh interpreter, first on its own and then followed by
+matplotlib.pyplot, which is what the first call of a plotting function costs. It also
+checks that importing a model does not import matplotlib, so worker processes that
+never plot don't pay for it.
+
+Example:
+    python benchmarks/bench_startup.py --repeats 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (directory, module)
+MODULES = [
+    ("abelian_sandpile", "abelian_sandpile"),
+    ("abelian_sandpile", "batched_sandpile"),
+    ("percolation", "percolation"),
+    ("percolation", "sweep"),
+    ("game_of_life", "main"),
+    ("game_of_life", "hashlife"),
+    ("river_evolution", "river_evolution"),
+]
+
+# runs in the fresh interpreter, prints the timings as JSON
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import numpy
+numpy_done = time.perf_counter()
+import {module}
+module_done = time.perf_counter()
+headless = "matplotlib" not in sys.modules
+import matplotlib.pyplot
+plot_done = time.perf_counter()
+print(json.dumps({{
+    "numpy_s": numpy_done - start,
+    "module_s": module_done - numpy_done,
+    "plotting_s": plot_done - module_done,
+    "headless": headless,
+}}))
+"""
+
+
+def time_import(directory, module):
+    """Import a module in a fresh interpreter and return its timings"""
+    out = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(module=module)],
+        cwd=os.path.join(ROOT, directory), capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the model modules")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="fresh interpreters per module, the best time is kept")
+    parser.add_argument("--out", default=None, help="optional JSON file of results")
+    args = parser.parse_args()
+
+    results = dict()
+    print("{:<20s} {:>10s} {:>14s} {:>10s}".format("module", "import ms",
+                                                   "+ pyplot ms", "headless"))
+    for directory, module in MODULES:
+        runs = [time_import(directory, module) for k in range(args.repeats)]
+        best = {
+            "module_s": min(r["module_s"] for r in runs),
+            "plotting_s": min(r["plotting_s"] for r in runs),
+            "headless": all(r["headless"] for r in runs),
+        }
+        results[module] = best
+        print("{:<20s} {:>10.1f} {:>14.1f} {:>10s}".format(
+            module, best["module_s"] * 1e3,
+            (best["module_s"] + best["plotting_s"]) * 1e3, str(best["headless"])
+        ))
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Timing tracer for the hot paths of the simulation classes.
+
+AbelianSandpile, PercolationSimulation, Game_of_Life and River_Evolution have a tracer
+class attribute that is None by default, so the instrumented code only pays for one
+attribute check. Attach a Tracer to a class (every instance is traced) or to a single
+instance, and the instrumented sections report to it:
+
+    sandpile.step, sandpile.wave          a grain drop, and every toppling wave
+    percolation.flow_row,
+    percolation.poll_neighbors            every row filled by _flow, and every neighbor poll
+    game_of_life.step                     every generation
+    game_of_life.savefig                  matplotlib rendering and saving in simulate()
+    river.evolve, river.move              every _evolve call, and every unit of water moved
+
+The recorded events can be saved as a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev) or summed up in a table.
+
+Example:
+    tracer = Tracer()
+    tracer.attach(AbelianSandpile, Game_of_Life)
+    ...
+    tracer.detach(AbelianSandpile, Game_of_Life)
+    print(tracer.table())
+    tracer.save_chrome_trace("trace.json")
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+
+    # integer nanoseconds, cheaper to read and subtract than floats
+    clock = staticmethod(time.perf_counter_ns)
+
+    def __init__(self, max_events=1_000_000):
+        """
+        Args:
+            max_events (int): number of individual events kept for the timeline. Later
+                events are still counted in the aggregated table.
+        """
+        self.max_events = max_events
+        self.events = list() # (name, start ns, duration ns, thread id)
+        self.dropped = 0
+        # name -> [calls, total ns, min ns, max ns]; sections that are only counted
+        # have no times
+        self.totals = dict()
+        self._origin = self.clock()
+
+    def record(self, name, start):
+        """
+        Record a section that started at start = tracer.clock() and ends now.
+        """
+        end = self.clock()
+        duration = end - start
+        total = self.totals.get(name)
+        if total is None:
+            self.totals[name] = [1, duration, duration, duration]
+        else:
+            total[0] += 1
+            total[1] += duration
+            if duration < total[2]:
+                total[2] = duration
+            if duration > total[3]:
+                total[3] = duration
+        if len(self.events) < self.max_events:
+            self.events.append((name, start, duration, threading.get_ident()))
+        else:
+            self.dropped += 1
+
+    def count(self, name, k=1):
+        """Count k occurrences of a section without timing it"""
+        total = self.totals.get(name)
+        if total is None:
+            self.totals[name] = [k, None, None, None]
+        else:
+            total[0] += k
+
+    @contextmanager
+    def span(self, name):
+        """Time a block of code, such as plotting done outside the classes"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def attach(self, *targets):
+        """Trace the given classes or instances"""
+        for target in targets:
+            target.tracer = self
+
+    @staticmethod
+    def detach(*targets):
+        """Stop tracing the given classes or instances"""
+        for target in targets:
+            if isinstance(target, type):
+                target.tracer = None
+            else:
+                # fall back to the class attribute
+                target.__dict__.pop("tracer", None)
+
+    def reset(self):
+        self.events = list()
+        self.dropped = 0
+        self.totals = dict()
+        self._origin = self.clock()
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict): for every section, "calls", and for timed sections the
+                "total_s", "mean_s", "min_s" and "max_s"
+        """
+        summary = dict()
+        for name, (calls, total, low, high) in self.totals.items():
+            row = {"calls": calls}
+            if total is not None:
+                row.update({
+                    "total_s": total * 1e-9,
+                    "mean_s": total * 1e-9 / calls,
+                    "min_s": low * 1e-9,
+                    "max_s": high * 1e-9,
+                })
+            summary[name] = row
+        return summary
+
+    def table(self):
+        """Aggregated table of the sections, the slowest in total first"""
+        summary = self.summary()
+        lines = ["{:<28s} {:>10s} {:>12s} {:>12s} {:>12s} {:>12s}".format(
+            "section", "calls", "total ms", "mean us", "min us", "max us"
+        )]
+        for name in sorted(summary, key=lambda name: -summary[name].get("total_s", 0)):
+            row = summary[name]
+            if "total_s" in row:
+                lines.append("{:<28s} {:>10d} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                    name, row["calls"], row["total_s"] * 1e3, row["mean_s"] * 1e6,
+                    row["min_s"] * 1e6, row["max_s"] * 1e6
+                ))
+            else:
+                lines.append("{:<28s} {:>10d}".format(name, row["calls"]))
+        if self.dropped:
+            lines.append("({} events not kept for the timeline)".format(self.dropped))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """
+        The events in the Chrome trace event format, as complete ("X") events with
+        microsecond times relative to the creation of the tracer.
+        """
+        pid = os.getpid()
+        trace = [
+            {
+                "name": name, "cat": name.split(".")[0], "ph": "X", "pid": pid, "tid": tid,
+                "ts": (start - self._origin) / 1e3, "dur": duration / 1e3,
+            }
+            for name, start, duration, tid in self.events
+        ]
+        # counted sections have no timeline, so they are added as a single counter
+        for name, (calls, total, low, high) in self.totals.items():
+            if total is None:
+                trace.append({
+                    "name": name, "ph": "C", "pid": pid, "tid": 0,
+                    "ts": (self.clock() - self._origin) / 1e3, "args": {"calls": calls},
+                })
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
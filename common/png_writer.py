@@ -0,0 +1,38 @@
+"""
+Minimal PNG encoder for the frame exporters, so writing a frame needs neither
+matplotlib nor an imaging library.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+
+def write_png(path, image, level=6):
+    """
+    Write a uint8 image to an 8-bit PNG file.
+
+    Args:
+        path (str): file to write
+        image (np.ndarray): (height, width) grayscale or (height, width, 3) RGB array
+        level (int): zlib compression level
+    """
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    if channels not in (1, 3):
+        raise ValueError("image must be gray or RGB, got shape {}".format(image.shape))
+    # every scanline starts with filter type 0 (no filter)
+    raw = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * channels)
+    color_type = 0 if channels == 1 else 2
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_png_chunk(b"IHDR", header))
+        f.write(_png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level)))
+        f.write(_png_chunk(b"IEND", b""))
@@ -0,0 +1,33 @@
+"""
+Helpers shared by the lattice models. The model directories are not packages, so a
+module that needs them puts this directory on sys.path first, once:
+
+    if COMMON not in sys.path:
+        sys.path.insert(0, COMMON)
+    from random_fill import random_choice
+"""
+import numpy as np
+
+
+def random_choice(values, out, p=None, block_size=1 << 20):
+    """
+    Fill out with np.random.choice(values, size=out.shape, p=p), drawn a block of rows
+    at a time, so the int64 draws never take much more than block_size elements and the
+    lattice can be stored in a small dtype. The draws come out of the global random
+    state in the same order, so the result equals the one-shot call.
+
+    Args:
+        values (list): values to draw from
+        out (np.ndarray): array to fill, which can be a view such as the inside of a
+            padded lattice
+        p (list): probability of each value, uniform if None
+        block_size (int): number of elements drawn at a time
+
+    Returns:
+        out (np.ndarray): the filled array
+    """
+    rows = max(block_size // max(out[0].size, 1), 1) if len(out) else 1
+    for start in range(0, len(out), rows):
+        block = out[start:start + rows]
+        block[...] = np.random.choice(values, size=block.shape, p=p)
+    return out
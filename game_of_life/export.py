@@ -0,0 +1,143 @@
+"""
+Frame export for Game_of_Life.simulate.
+
+Frames are turned into raw uint8 images (dead cells black, live cells white, like
+imshow with the gray colormap) and encoded on a background thread, either to numbered
+PNG files or by piping them into a video/GIF encoder such as ffmpeg. The queue between
+the simulation and the encoder is bounded, so a slow encoder makes the simulation wait
+instead of letting memory grow.
+"""
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+import numpy as np
+
+_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if _COMMON not in sys.path:
+    sys.path.insert(0, _COMMON)
+
+from png_writer import write_png
+
+
+class FrameExporter:
+    """
+    Export stage for Game_of_Life.simulate. Pass it as simulate(n_step, exporter=...)
+    and close it (or use it as a context manager) to wait for the encoder to finish.
+    """
+
+    def __init__(self, out_dir="figs", interval=1, mode="png", output=None, fps=30,
+                 scale=1, max_queue=16, command=None):
+        """
+        Args:
+            out_dir (str): directory of the PNG frames, created if missing
+            interval (int): export every interval-th generation
+            mode (str): "png" writes numbered PNG files, "pipe" writes the raw frames
+                to the standard input of an encoder process
+            output (str): video or GIF file written by the encoder in "pipe" mode
+            fps (int): frame rate of the video
+            scale (int): every cell is drawn as a scale x scale block of pixels
+            max_queue (int): number of frames that can wait for the encoder before
+                submit() blocks
+            command (list): encoder command for "pipe" mode. It must read gray 8-bit
+                raw frames from its standard input. Defaults to ffmpeg.
+        """
+        if mode not in ("png", "pipe"):
+            raise ValueError("mode must be 'png' or 'pipe', got {}".format(mode))
+        if mode == "pipe" and output is None and command is None:
+            raise ValueError("pipe mode needs an output file or an encoder command")
+        self.out_dir = out_dir
+        self.interval = interval
+        self.mode = mode
+        self.output = output
+        self.fps = fps
+        self.scale = scale
+        self.command = command
+        self.n_frames = 0
+        if mode == "png":
+            os.makedirs(out_dir, exist_ok=True)
+        self._encoder = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._encode_frames, daemon=True)
+        self._thread.start()
+
+    def submit(self, generation, grid):
+        """
+        Queue the grid of a generation if it falls on the export interval. Blocks while
+        the queue is full.
+        """
+        if self._error is not None:
+            raise self._error
+        if generation % self.interval != 0:
+            return
+        # copy, since the simulation keeps writing to its buffers
+        self._queue.put((generation, np.array(grid == 1, dtype=np.uint8)))
+        self.n_frames += 1
+
+    def _image(self, cells):
+        image = cells * np.uint8(255)
+        if self.scale > 1:
+            image = np.repeat(np.repeat(image, self.scale, axis=0), self.scale, axis=1)
+        return image
+
+    def _start_encoder(self, height, width):
+        command = self.command
+        if command is None:
+            command = [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "gray", "-s", "{}x{}".format(width, height),
+                "-r", str(self.fps), "-i", "-",
+            ]
+            if not self.output.endswith(".gif"):
+                command += ["-pix_fmt", "yuv420p"]
+            command.append(self.output)
+        return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def _encode_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue # keep draining so submit() never blocks forever
+            generation, cells = item
+            try:
+                image = self._image(cells)
+                if self.mode == "png":
+                    path = os.path.join(self.out_dir, "step_{:05d}.png".format(generation))
+                    write_png(path, image)
+                else:
+                    if self._encoder is None:
+                        # yuv420p video needs even dimensions
+                        self._height = image.shape[0] + image.shape[0] % 2
+                        self._width = image.shape[1] + image.shape[1] % 2
+                        self._encoder = self._start_encoder(self._height, self._width)
+                    frame = np.zeros((self._height, self._width), dtype=np.uint8)
+                    frame[:image.shape[0], :image.shape[1]] = image
+                    self._encoder.stdin.write(frame.tobytes())
+            except Exception as error:
+                self._error = error
+
+    def close(self):
+        """Wait until every queued frame is encoded and the encoder has finished"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._encoder is not None:
+            self._encoder.stdin.close()
+            if self._encoder.wait() != 0 and self._error is None:
+                self._error = RuntimeError(
+                    "encoder exited with status {}".format(self._encoder.returncode)
+                )
+            self._encoder = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
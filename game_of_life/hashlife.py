@@ -0,0 +1,352 @@
+"""
+Hashlife backend for the Game of Life.
+
+The board is an unbounded plane stored as a quadtree. Identical subtrees are stored
+once (hash-consing), so a node is identified by its four children, and the future of a
+node is memoized: the center of a node of level k (2^k x 2^k cells) can be advanced by
+up to 2^(k-2) generations in one lookup once it has been computed. Patterns with a lot
+of repetition in space and time can be run for millions of generations this way.
+
+Unlike Game_of_Life, the plane has no edges. The two agree as long as the pattern stays
+away from the edges of the dense grid.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from main import Game_of_Life
+
+
+class _Node:
+    """
+    Quadtree node of level k, covering 2^k x 2^k cells. Level 0 nodes are single
+    cells. Nodes are only created through Hashlife._join, which returns the existing
+    node if one with the same children was already made, so nodes can be compared and
+    hashed by identity.
+    """
+    __slots__ = ("k", "nw", "ne", "sw", "se", "population")
+
+    def __init__(self, k, nw, ne, sw, se, population):
+        self.k = k
+        self.nw, self.ne, self.sw, self.se = nw, ne, sw, se
+        self.population = population
+
+
+class Hashlife:
+
+    def __init__(self, initial_grid=None, n=100, random_state=None, max_cache=1_000_000,
+                 max_nodes=5_000_000):
+        """
+        Initialize a Hashlife object from a dense grid, in the same way as Game_of_Life.
+
+        Args:
+            initial_grid (np.ndarray): starting grid. Cell (i, j) of the grid is cell
+                (i, j) of the plane.
+            n (int): if no grid is given, a random (n+1) x (n+1) grid is used, like
+                Game_of_Life
+            random_state (int): random seed for numpy's random number generator
+            max_cache (int): maximum number of memoized results. The least recently
+                used results are evicted first.
+            max_nodes (int): when more nodes than this exist, nodes that are no longer
+                part of the board are dropped, together with the memoized results. This
+                is checked during a skip as well, so a single large skip stays bounded.
+                If most nodes are still in use after a collection, the next one waits
+                until the table has doubled, so a board larger than max_nodes does not
+                collect over and over. A skip that needs far more nodes at once than
+                max_nodes still gives the right board, but recomputes a lot.
+        """
+        if initial_grid is None:
+            np.random.seed(random_state) # Set the random seed
+            initial_grid = np.random.choice([0, 1], size=(n+1, n+1))
+        self.max_cache = max_cache
+        self.max_nodes = max_nodes
+        self.shape = initial_grid.shape
+        self.dtype = initial_grid.dtype
+        self.generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._nodes = dict()
+        self._node_limit = max_nodes
+        self._results = OrderedDict()
+        self._off = _Node(0, None, None, None, None, 0)
+        self._on = _Node(0, None, None, None, None, 1)
+        self._zeros = [self._off]
+
+        cells = np.asarray(initial_grid) == 1
+        k = 3
+        while 2**k < max(cells.shape):
+            k += 1
+        # world coordinates of the top left cell of the root node
+        self.top, self.left = 0, 0
+        self.root = self._from_cells(cells, 0, 0, k)
+
+    @classmethod
+    def from_game(cls, game, **kwargs):
+        """Create a Hashlife board from the grid of a Game_of_Life object"""
+        return cls(initial_grid=game.grid, **kwargs)
+
+    def to_game(self):
+        """Create a Game_of_Life object from the current window of the board"""
+        return Game_of_Life(initial_grid=self.grid)
+
+    ## Building nodes
+
+    def _join(self, nw, ne, sw, se):
+        """Return the unique node with the given four children"""
+        key = (nw, ne, sw, se)
+        node = self._nodes.get(key)
+        if node is None:
+            population = nw.population + ne.population + sw.population + se.population
+            node = _Node(nw.k + 1, nw, ne, sw, se, population)
+            self._nodes[key] = node
+        return node
+
+    def _zero(self, k):
+        """Return the empty node of level k"""
+        while len(self._zeros) <= k:
+            z = self._zeros[-1]
+            self._zeros.append(self._join(z, z, z, z))
+        return self._zeros[k]
+
+    def _from_cells(self, cells, top, left, k):
+        """Build the node of level k whose top left cell is cells[top, left]"""
+        size = 2**k
+        if not cells[top:top + size, left:left + size].any():
+            return self._zero(k)
+        if k == 0:
+            return self._on
+        half = size // 2
+        return self._join(
+            self._from_cells(cells, top, left, k - 1),
+            self._from_cells(cells, top, left + half, k - 1),
+            self._from_cells(cells, top + half, left, k - 1),
+            self._from_cells(cells, top + half, left + half, k - 1),
+        )
+
+    def _centre(self, m):
+        """Return the node of level k+1 that has m in its center, with empty margins"""
+        z = self._zero(m.k - 1)
+        return self._join(
+            self._join(z, z, z, m.nw), self._join(z, z, m.ne, z),
+            self._join(z, m.sw, z, z), self._join(m.se, z, z, z),
+        )
+
+    def _inner(self, m):
+        """Return the node of level k-1 at the center of m"""
+        return self._join(m.nw.se, m.ne.sw, m.sw.ne, m.se.nw)
+
+    ## Evolution
+
+    def _life_4x4(self, m):
+        """Advance the center 2 x 2 cells of a level 2 node by one generation"""
+        rows = [
+            [m.nw.nw, m.nw.ne, m.ne.nw, m.ne.ne],
+            [m.nw.sw, m.nw.se, m.ne.sw, m.ne.se],
+            [m.sw.nw, m.sw.ne, m.se.nw, m.se.ne],
+            [m.sw.sw, m.sw.se, m.se.sw, m.se.se],
+        ]
+        cells = [[cell.population for cell in row] for row in rows]
+
+        def next_cell(i, j):
+            count = sum(
+                cells[i + di][j + dj] for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                if di != 0 or dj != 0
+            )
+            alive = cells[i][j] == 1
+            return self._on if count == 3 or (alive and count == 2) else self._off
+
+        return self._join(next_cell(1, 1), next_cell(1, 2), next_cell(2, 1), next_cell(2, 2))
+
+    def _successor(self, m, j):
+        """
+        Return the center of node m (level k-1) advanced by 2^j generations, with
+        j <= k - 2. Results are memoized by (node, j) in a least-recently-used cache.
+        """
+        j = min(j, m.k - 2)
+        if m.population == 0:
+            return m.nw
+        key = (m, j)
+        result = self._results.get(key)
+        if result is not None:
+            self.cache_hits += 1
+            self._results.move_to_end(key)
+            return result
+        self.cache_misses += 1
+        if len(self._nodes) > self._node_limit:
+            # the table filled up in the middle of a skip
+            self._collect(m)
+
+        if m.k == 2:
+            result = self._life_4x4(m)
+        else:
+            a, b, c, d = m.nw, m.ne, m.sw, m.se
+            # nine overlapping sub-nodes of level k-1, advanced to level k-2 nodes
+            c1 = self._successor(a, j)
+            c2 = self._successor(self._join(a.ne, b.nw, a.se, b.sw), j)
+            c3 = self._successor(b, j)
+            c4 = self._successor(self._join(a.sw, a.se, c.nw, c.ne), j)
+            c5 = self._successor(self._join(a.se, b.sw, c.ne, d.nw), j)
+            c6 = self._successor(self._join(b.sw, b.se, d.nw, d.ne), j)
+            c7 = self._successor(c, j)
+            c8 = self._successor(self._join(c.ne, d.nw, c.se, d.sw), j)
+            c9 = self._successor(d, j)
+            if j < m.k - 2:
+                # the sub-nodes are already advanced by 2^j, only take their centers
+                result = self._join(
+                    self._join(c1.se, c2.sw, c4.ne, c5.nw),
+                    self._join(c2.se, c3.sw, c5.ne, c6.nw),
+                    self._join(c4.se, c5.sw, c7.ne, c8.nw),
+                    self._join(c5.se, c6.sw, c8.ne, c9.nw),
+                )
+            else:
+                # advance by 2^(k-3) twice
+                result = self._join(
+                    self._successor(self._join(c1, c2, c4, c5), j),
+                    self._successor(self._join(c2, c3, c5, c6), j),
+                    self._successor(self._join(c4, c5, c7, c8), j),
+                    self._successor(self._join(c5, c6, c8, c9), j),
+                )
+
+        self._results[key] = result
+        if len(self._results) > self.max_cache:
+            self._results.popitem(last=False)
+        return result
+
+    def _is_padded(self, m):
+        """Whether all live cells of m are in the center half of m"""
+        return m.k >= 3 and self._inner(m).population == m.population
+
+    def _collect(self, *keep):
+        """
+        Drop the nodes that are not part of the board, or of the nodes in keep, any
+        more. The most recently used memoized results are kept, with their nodes, up to
+        half of max_nodes, and the other results are dropped.
+
+        Nodes still held by a skip in progress but not kept are no longer in the table,
+        so an equal node made later is a different object. That only costs memoized
+        results, the board stays correct.
+        """
+        self._nodes = dict()
+        self._zeros = [self._off]
+        for node in (self.root, *keep):
+            self._mark(node)
+        kept = list()
+        for key, result in reversed(self._results.items()):
+            if len(self._nodes) >= self.max_nodes // 2:
+                break
+            self._mark(key[0])
+            self._mark(result)
+            kept.append((key, result))
+        self._results = OrderedDict(reversed(kept))
+        self._node_limit = max(self.max_nodes, 2 * len(self._nodes))
+
+    def _mark(self, node):
+        """Put node and its descendants back in the node table"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            key = (node.nw, node.ne, node.sw, node.se)
+            if node.k == 0 or key in self._nodes:
+                continue
+            self._nodes[key] = node
+            stack.extend(key)
+
+    def skip(self, k):
+        """
+        Advance the board by 2^k generations. This is the fast path: the root is padded
+        until it is large enough, and advanced with a single memoized lookup.
+        """
+        if len(self._nodes) > self.max_nodes:
+            self._collect()
+        if self.root.population == 0:
+            self.generation += 2**k
+            return
+        while self.root.k < k + 2 or not self._is_padded(self.root):
+            half = 2**(self.root.k - 1)
+            self.root = self._centre(self.root)
+            self.top -= half
+            self.left -= half
+        # advancing the centered root gives a node with the same footprint as the root
+        self.root = self._successor(self._centre(self.root), k)
+        self.generation += 2**k
+        # drop empty margins so the root does not keep growing
+        while self.root.k > 3 and self._is_padded(self._inner(self.root)):
+            quarter = 2**(self.root.k - 2)
+            self.root = self._inner(self.root)
+            self.top += quarter
+            self.left += quarter
+
+    def advance(self, n_gen):
+        """Advance the board by n_gen generations, using skip() for each bit of n_gen"""
+        k = 0
+        while n_gen > 0:
+            if n_gen & 1:
+                self.skip(k)
+            n_gen >>= 1
+            k += 1
+
+    def step(self):
+        """Advance the board by one generation"""
+        self.skip(0)
+
+    def simulate(self, n_step):
+        """
+        Simulate the board for n_step generations, and return the dense grid.
+        """
+        self.advance(n_step)
+        return self.grid
+
+    ## Dense conversion
+
+    @property
+    def population(self):
+        return self.root.population
+
+    def to_grid(self, top=0, left=0, height=None, width=None):
+        """
+        Return a dense window of the plane.
+
+        Args:
+            top, left (int): world coordinates of the top left cell of the window
+            height, width (int): size of the window, defaults to the initial grid shape
+        """
+        if height is None:
+            height = self.shape[0]
+        if width is None:
+            width = self.shape[1]
+        out = np.zeros((height, width), dtype=self.dtype)
+        stack = [(self.root, self.top, self.left)]
+        while stack:
+            node, node_top, node_left = stack.pop()
+            size = 2**node.k
+            if (node.population == 0 or node_top >= top + height or node_left >= left + width
+                    or node_top + size <= top or node_left + size <= left):
+                continue
+            if node.k == 0:
+                out[node_top - top, node_left - left] = 1
+                continue
+            half = size // 2
+            stack.extend((
+                (node.nw, node_top, node_left), (node.ne, node_top, node_left + half),
+                (node.sw, node_top + half, node_left), (node.se, node_top + half, node_left + half),
+            ))
+        return out
+
+    @property
+    def grid(self):
+        """Dense grid of the same window as the initial grid"""
+        return self.to_grid()
+
+
+if __name__ == "__main__":
+    # a glider, run for a million generations
+    glider = np.array([[0, 1, 0],
+                       [0, 0, 1],
+                       [1, 1, 1]])
+    model = Hashlife(initial_grid=glider)
+    model.skip(20)
+    offset = 2**20 // 4 # a glider moves one cell diagonally every 4 generations
+    print(model.generation, model.population)
+    print(model.to_grid(top=offset, left=offset, height=3, width=3))
+    print("cache hits {}, misses {}".format(model.cache_hits, model.cache_misses))
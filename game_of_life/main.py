@@ -1,17 +1,72 @@
+import os
+import sys
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if _COMMON not in sys.path:
+    sys.path.insert(0, _COMMON)
+
+from random_fill import random_choice
 
 class Game_of_Life:
 
-    def __init__(self, n=100, initial_grid = None, random_state=None):
+    # Tracer timing game_of_life.step and game_of_life.savefig
+    tracer = None
+
+    def __init__(self, n=100, initial_grid = None, random_state=None, engine="python",
+                 tile_size=32, memory="default"):
+        """
+        Initialize a Game_of_Life object.
+
+        Args:
+            n (int): number of rows and columns that are updated. The grid has one more
+                row and column, which are never updated and never counted as neighbors.
+            initial_grid (np.ndarray): optional starting grid, overrides n
+            random_state (int): random seed for numpy's random number generator
+            engine (str): how step() updates the grid. "python" visits every cell in a
+                Python loop, "vectorized" sums shifted copies of the grid, and
+                "bitpacked" stores 64 cells per uint64 word and updates whole words with
+                bitwise adders. "sparse" only recomputes the tiles that changed in the last
+                generation and their neighbors. All of them follow the same rule and
+                boundary.
+            tile_size (int): number of rows and columns of a tile in the sparse engine
+            memory (str): "default" keeps the grid as given, or as int64 when it is
+                drawn at random. "lean" stores both buffers as uint8.
+        """
+        if engine not in ("python", "vectorized", "bitpacked", "sparse"):
+            raise ValueError(
+                "engine must be 'python', 'vectorized', 'bitpacked' or 'sparse', got {}".format(engine)
+            )
+        if memory not in ("default", "lean"):
+            raise ValueError("memory must be 'default' or 'lean', got {}".format(memory))
+        self.engine = engine
+        self.tile_size = tile_size
+        self.memory = memory
         if initial_grid is not None:
             self.grid = initial_grid
             self.n = initial_grid.shape[0]-1
+            if memory == "lean":
+                self.grid = initial_grid.astype(np.uint8)
+            elif engine != "python":
+                # the buffers are swapped between steps, so don't write into the caller's array
+                self.grid = initial_grid.copy()
         else:
             self.n = n
             np.random.seed(random_state) # Set the random seed
-            self.grid = np.random.choice([0, 1], size=(n+1, n+1))
+            if memory == "lean":
+                self.grid = random_choice([0, 1], np.empty((n+1, n+1), dtype=np.uint8))
+            else:
+                self.grid = np.random.choice([0, 1], size=(n+1, n+1))
         self.new_grid = self.grid.copy()
+        # scratch buffers of the vectorized engine, allocated on the first step
+        self._live = None
+        # packed state of the bitpacked engine, packed from the grid on the first step
+        self._words = None
+        # tiles the sparse engine recomputes next step, and how many it recomputed per step
+        n_tiles = -(-self.n // tile_size)
+        self._active_tiles = np.ones((n_tiles, n_tiles), dtype=bool)
+        self.active_tile_counts = list()
 
     def get_neighbors(self, i, j):
         """
@@ -40,6 +95,188 @@ class Game_of_Life:
         return sum_live
 
     def step(self):
+        """
+        Advance the grid by one generation
+        """
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.clock()
+        if self.engine == "vectorized":
+            self._step_vectorized()
+        elif self.engine == "sparse":
+            self._step_sparse()
+        elif self.engine == "bitpacked":
+            self._step_bitpacked()
+        else:
+            self._step_python()
+        if tracer is not None:
+            tracer.record("game_of_life.step", start)
+
+    def bytes_per_cell(self):
+        """
+        Memory held by the two grid buffers and the scratch buffers of the engine, per
+        cell of the grid
+        """
+        arrays = [self.grid, self.new_grid, self._active_tiles, self._words]
+        if self._live is not None:
+            arrays += [self._live, self._counts, self._born, self._survive]
+        if self._words is not None:
+            arrays.append(self._valid)
+        total = sum(a.nbytes for a in arrays if a is not None)
+        return total / self.grid.size
+
+    def _swap_buffers(self):
+        """Make new_grid the current grid, reusing the old grid as the next buffer"""
+        self.grid, self.new_grid = self.new_grid, self.grid
+
+    def _step_vectorized(self):
+        """
+        Count the live neighbors of every cell at once by adding eight shifted views of a
+        zero-padded copy of the live cells. Cells at index n or beyond are never counted,
+        like in _step_python. The result is written into new_grid and the two buffers
+        are swapped, so nothing the size of the grid is allocated per step.
+        """
+        n = self.n
+        if self._live is None:
+            self._live = np.zeros((n + 2, n + 2), dtype=bool)
+            self._counts = np.zeros((n, n), dtype=np.uint8)
+            self._born = np.zeros((n, n), dtype=bool)
+            self._survive = np.zeros((n, n), dtype=bool)
+        live, counts = self._live, self._counts
+        np.equal(self.grid[:n, :n], 1, out=live[1:-1, 1:-1])
+        counts[...] = 0
+        for di in (0, 1, 2):
+            for dj in (0, 1, 2):
+                if di != 1 or dj != 1:
+                    counts += live[di:di + n, dj:dj + n]
+        # a cell is alive next generation with 3 live neighbors, or with 2 if it is alive
+        np.equal(counts, 3, out=self._born)
+        np.equal(counts, 2, out=self._survive)
+        self._survive &= live[1:-1, 1:-1]
+        self._born |= self._survive
+        self.new_grid[:n, :n] = self._born
+        self._swap_buffers()
+
+    @staticmethod
+    def _next_generation(cells):
+        """
+        Next generation of a block of cells, treating everything outside the block as
+        dead. Used on blocks with a one-cell halo, so only the inner part is exact.
+        """
+        padded = np.zeros((cells.shape[0] + 2, cells.shape[1] + 2), dtype=np.uint8)
+        padded[1:-1, 1:-1] = cells
+        counts = np.zeros(cells.shape, dtype=np.uint8)
+        for di in (0, 1, 2):
+            for dj in (0, 1, 2):
+                if di != 1 or dj != 1:
+                    counts += padded[di:di + cells.shape[0], dj:dj + cells.shape[1]]
+        return (counts == 3) | (cells & (counts == 2))
+
+    def _step_sparse(self):
+        """
+        Recompute only the active tiles: the tiles that changed in the last generation
+        and their eight neighbors. Any other tile, and its neighborhood, was unchanged in
+        the last generation, so it stays the same. Its cells in new_grid (which holds the
+        previous generation after the buffer swap) are already correct.
+
+        Consecutive active tiles in a row of tiles are computed together as one block
+        with a one-cell halo. The number of active tiles is appended to
+        active_tile_counts every step.
+        """
+        n, size = self.n, self.tile_size
+        active = self._active_tiles
+        changed = np.zeros_like(active)
+        self.active_tile_counts.append(int(np.sum(active)))
+        for ti in np.flatnonzero(active.any(axis=1)):
+            row = active[ti]
+            # runs of consecutive active tiles in this row of tiles
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+            for first, last in zip(edges[::2], edges[1::2]):
+                r0, r1 = ti * size, min((ti + 1) * size, n)
+                c0, c1 = first * size, min(last * size, n)
+                # block with a one-cell halo, clipped to the cells that are counted
+                h0, h1 = max(r0 - 1, 0), min(r1 + 1, n)
+                g0, g1 = max(c0 - 1, 0), min(c1 + 1, n)
+                block = self._next_generation(self.grid[h0:h1, g0:g1] == 1)
+                new = block[r0 - h0:r1 - h0, c0 - g0:c1 - g0]
+                old = self.grid[r0:r1, c0:c1]
+                self.new_grid[r0:r1, c0:c1] = new
+                # which of the tiles in the run changed
+                changed_cols = np.any(new != (old == 1), axis=0)
+                starts = np.arange(0, c1 - c0, size)
+                changed[ti, first:last] = np.logical_or.reduceat(changed_cols, starts)
+        # the tiles to recompute next step are the changed tiles and their neighbors
+        padded = np.zeros((changed.shape[0] + 2, changed.shape[1] + 2), dtype=bool)
+        padded[1:-1, 1:-1] = changed
+        active[...] = False
+        for di in (0, 1, 2):
+            for dj in (0, 1, 2):
+                active |= padded[di:di + changed.shape[0], dj:dj + changed.shape[1]]
+        self._swap_buffers()
+
+    @staticmethod
+    def _pack(cells):
+        """Pack an (n, m) boolean array into (n, ceil(m / 64)) uint64 words, 64 cells
+        per word with column c in bit c % 64 of word c // 64"""
+        n_rows, n_cols = cells.shape
+        n_words = -(-n_cols // 64)
+        padded = np.zeros((n_rows, n_words * 64), dtype=bool)
+        padded[:, :n_cols] = cells
+        packed = np.packbits(padded, axis=1, bitorder="little")
+        return np.ascontiguousarray(packed).view("<u8").astype(np.uint64)
+
+    @staticmethod
+    def _unpack(words, n_cols):
+        """Inverse of _pack"""
+        packed = words.astype("<u8").view(np.uint8)
+        return np.unpackbits(packed, axis=1, bitorder="little")[:, :n_cols].astype(bool)
+
+    def _step_bitpacked(self):
+        """
+        Update 64 cells at a time. The eight neighbor planes are built with word shifts
+        (carrying bits across word boundaries) and row offsets, and added per bit with a
+        three-bit counter built from full adders. Bit 2 of the counter is kept set once
+        the count reaches 4, since any count of 4 or more kills the cell.
+        """
+        n = self.n
+        if self._words is None:
+            self._words = self._pack(self.grid[:n, :n] == 1)
+            # bits past column n - 1 must stay zero, so they are never counted
+            self._valid = self._pack(np.ones((1, n), dtype=bool))
+        words = self._words
+        one, carry = np.uint64(1), np.uint64(63)
+
+        # neighbors to the west and east, within the same row
+        west = words << one
+        west[:, 1:] |= words[:, :-1] >> carry
+        east = words >> one
+        east[:, :-1] |= words[:, 1:] << carry
+
+        planes = [west, east]
+        for row in (west, words, east):
+            above = np.zeros_like(row)
+            above[1:] = row[:-1]
+            below = np.zeros_like(row)
+            below[:-1] = row[1:]
+            planes += [above, below]
+
+        bit0 = np.zeros_like(words)
+        bit1 = np.zeros_like(words)
+        bit2 = np.zeros_like(words)
+        for plane in planes:
+            carry0 = bit0 & plane
+            bit0 ^= plane
+            carry1 = bit1 & carry0
+            bit1 ^= carry0
+            bit2 |= carry1
+
+        # alive next generation with a count of 3, or 2 if alive now
+        words = ~bit2 & bit1 & (bit0 | words) & self._valid
+        self._words = words
+        self.new_grid[:n, :n] = self._unpack(words, n)
+        self._swap_buffers()
+
+    def _step_python(self):
         for i in range(self.n):
             for j in range(self.n):
                 neighbor_list = self.get_neighbors(i, j)
@@ -55,14 +292,28 @@ class Game_of_Life:
                     pass
         self.grid = self.new_grid.copy()
     
-    def simulate(self, n_step):
+    def simulate(self, n_step, exporter=None):
         """
         Simulate the sandpile model for n_step steps.
+
+        Args:
+            n_step (int): number of generations
+            exporter (FrameExporter): export stage from export.py the generations are
+                handed to. Without one, every generation is saved with matplotlib.
         """
+        if exporter is None:
+            # only the matplotlib path needs matplotlib, so it is imported here
+            import matplotlib.pyplot as plt
+            os.makedirs("figs", exist_ok=True)
         for i in range(n_step):
             self.step()
+            if exporter is not None:
+                exporter.submit(i + 1, self.grid)
+                continue
             # plot the grid every 100 steps
             if i % 1 == 0:
+                if self.tracer is not None:
+                    start = self.tracer.clock()
                 plt.figure(figsize=(10, 10))
                 plt.imshow(self.grid, cmap='gray')
                 # plt.title(f"Step {i}")
@@ -72,10 +323,15 @@ class Game_of_Life:
                 plt.savefig(f"figs/step_0{i+1}.png")
                 # close the figure
                 plt.close()
+                if self.tracer is not None:
+                    self.tracer.record("game_of_life.savefig", start)
 
         return self.grid
 
+
 if __name__ == "__main__":
+    from export import FrameExporter
+
     # a glider
     glider = np.array([[0, 1, 0],
                         [0, 0, 1],
@@ -88,6 +344,8 @@ if __name__ == "__main__":
     initial_grid[5:8, 13:16] = glider
     initial_grid[3, 14] = 1
     model = Game_of_Life(n=9, initial_grid = initial_grid, random_state=0)
-    model.simulate(100)
+    with FrameExporter("figs", interval=1, scale=20) as exporter:
+        model.simulate(100, exporter=exporter)
 
-    # ffmpeg -f image2 -i thumb/%001d.jpg -vf scale=480x240 -r 30 out.gif
+    # or pipe the frames straight into ffmpeg:
+    # FrameExporter(mode="pipe", output="out.gif", fps=30, scale=20)
@@ -0,0 +1,266 @@
+"""
+Multi-core Game of Life for very large boards.
+
+The current and the next generation are kept in two buffers in shared memory. The
+updated rows are split into bands, one per worker, and every worker computes the next
+generation of its band from the current buffer, reading one halo row above and below
+it. The workers wait for each other at a barrier after every generation and then swap
+the roles of the two buffers, so nothing is copied between generations.
+
+Workers are processes by default. With backend="thread" they are threads instead,
+which also runs in parallel since numpy releases the GIL in the array operations.
+
+The rule and the boundary are the same as Game_of_Life's: the last row and column of
+the grid are never updated and never counted as neighbors.
+
+Example:
+    python parallel.py --n 10000 --workers 1 2 4 8 --generations 20
+"""
+import argparse
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from main import Game_of_Life
+
+
+def _band_worker(index, bounds, buffers, n, barrier, commands, results):
+    """
+    Advance the band of rows bounds[index] .. bounds[index+1]-1 for as many generations
+    as each command asks, waiting at the barrier after every generation.
+    """
+    r0, r1 = bounds[index], bounds[index + 1]
+    rows = r1 - r0
+    # live cells of the band with a halo row and column on every side, zero outside
+    live = np.zeros((rows + 2, n + 2), dtype=np.uint8)
+    column = np.zeros((rows, n + 2), dtype=np.uint8)
+    counts = np.zeros((rows, n), dtype=np.uint8)
+    born = np.zeros((rows, n), dtype=bool)
+    survive = np.zeros((rows, n), dtype=bool)
+    # halo rows that are inside the updated part of the grid
+    top, bottom = max(r0 - 1, 0), min(r1 + 1, n)
+
+    while True:
+        command = commands.get()
+        if command is None:
+            return
+        current, n_gen = command
+        try:
+            for generation in range(n_gen):
+                src, dst = buffers[current], buffers[1 - current]
+                live[1 + top - r0:1 + bottom - r0, 1:-1] = src[top:bottom, :n]
+                # 3 x 3 box sums, as a sum over three rows and then three columns
+                np.add(live[:-2], live[1:-1], out=column)
+                column += live[2:]
+                np.add(column[:, :-2], column[:, 1:-1], out=counts)
+                counts += column[:, 2:]
+                counts -= live[1:-1, 1:-1]
+                # alive next generation with 3 live neighbors, or with 2 if alive now
+                np.equal(counts, 3, out=born)
+                np.equal(counts, 2, out=survive)
+                survive &= live[1:-1, 1:-1].view(bool)
+                born |= survive
+                dst[r0:r1, :n] = born
+                barrier.wait()
+                current = 1 - current
+            results.put((index, None))
+        except Exception as error:
+            barrier.abort()
+            results.put((index, error))
+
+
+def _process_worker(index, bounds, names, shape, n, barrier, commands, results):
+    """Attach to the shared buffers and run _band_worker in a worker process"""
+    shms = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        buffers = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf) for shm in shms]
+        _band_worker(index, bounds, buffers, n, barrier, commands, results)
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+class ParallelGameOfLife:
+    """
+    Game of Life board stepped by a pool of workers that each own a band of rows. Use
+    it as a context manager, or call close(), to stop the workers and free the shared
+    memory.
+    """
+
+    def __init__(self, n=100, initial_grid=None, random_state=None, n_workers=4,
+                 backend="process"):
+        """
+        Initialize a ParallelGameOfLife object.
+
+        Args:
+            n (int): number of rows and columns that are updated, like Game_of_Life
+            initial_grid (np.ndarray): optional starting grid, overrides n
+            random_state (int): random seed for numpy's random number generator
+            n_workers (int): number of workers, at most n
+            backend (str): "process" runs the workers in processes on shared memory,
+                "thread" in threads of this process
+        """
+        if backend not in ("process", "thread"):
+            raise ValueError("backend must be 'process' or 'thread', got {}".format(backend))
+        if initial_grid is None:
+            np.random.seed(random_state) # Set the random seed
+            initial_grid = np.random.choice([0, 1], size=(n+1, n+1))
+        self.n = initial_grid.shape[0] - 1
+        self.n_workers = min(n_workers, self.n)
+        self.backend = backend
+        self.bounds = np.linspace(0, self.n, self.n_workers + 1).astype(int)
+        self.generation = 0
+        shape = initial_grid.shape
+
+        if backend == "process":
+            self._shms = [
+                shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+                for k in range(2)
+            ]
+            self._buffers = [
+                np.ndarray(shape, dtype=np.uint8, buffer=shm.buf) for shm in self._shms
+            ]
+            self._barrier = mp.Barrier(self.n_workers)
+            self._commands = [mp.Queue() for w in range(self.n_workers)]
+            self._results = mp.Queue()
+            names = [shm.name for shm in self._shms]
+            self._workers = [
+                mp.Process(
+                    target=_process_worker,
+                    args=(w, self.bounds, names, shape, self.n, self._barrier,
+                          self._commands[w], self._results),
+                    daemon=True,
+                )
+                for w in range(self.n_workers)
+            ]
+        else:
+            self._shms = list()
+            self._buffers = [np.zeros(shape, dtype=np.uint8) for k in range(2)]
+            self._barrier = threading.Barrier(self.n_workers)
+            self._commands = [queue.Queue() for w in range(self.n_workers)]
+            self._results = queue.Queue()
+            self._workers = [
+                threading.Thread(
+                    target=_band_worker,
+                    args=(w, self.bounds, self._buffers, self.n, self._barrier,
+                          self._commands[w], self._results),
+                    daemon=True,
+                )
+                for w in range(self.n_workers)
+            ]
+        # the last row and column are never written, so both buffers hold them
+        for buffer in self._buffers:
+            buffer[...] = initial_grid == 1
+        self._current = 0
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def grid(self):
+        """The current generation (a view of the shared buffer, not a copy)"""
+        return self._buffers[self._current]
+
+    def step(self, n_gen=1):
+        """
+        Advance the board by n_gen generations. The workers only synchronize with each
+        other in between, so larger n_gen means less overhead per generation.
+        """
+        for commands in self._commands:
+            commands.put((self._current, n_gen))
+        replies = [self._results.get() for w in range(self.n_workers)]
+        errors = [error for index, error in replies if error is not None]
+        if errors:
+            broken = [e for e in errors if not isinstance(e, threading.BrokenBarrierError)]
+            raise (broken or errors)[0]
+        self._current = (self._current + n_gen) % 2
+        self.generation += n_gen
+
+    def simulate(self, n_step):
+        """
+        Simulate the board for n_step generations, and return the grid.
+        """
+        self.step(n_step)
+        return self.grid
+
+    def close(self):
+        """Stop the workers and free the shared memory"""
+        if self._workers is None:
+            return
+        grid = self.grid.copy()
+        for commands in self._commands:
+            commands.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+        # keep the final grid after the memory is freed
+        self._buffers = [grid, grid]
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark(n=4096, worker_counts=(1, 2, 4, 8), n_gen=20, backend="process",
+              random_state=0):
+    """
+    Measure the generations per second for every number of workers, on the same board.
+
+    Returns:
+        results (list): one dict per worker count with the "workers",
+            "generations_per_s", "cells_per_s" and "speedup" over one worker
+    """
+    np.random.seed(random_state)
+    initial_grid = np.random.choice([0, 1], size=(n+1, n+1)).astype(np.uint8)
+    results = list()
+    for n_workers in worker_counts:
+        with ParallelGameOfLife(initial_grid=initial_grid, n_workers=n_workers,
+                                backend=backend) as board:
+            board.step(1) # warm up the workers
+            start = time.perf_counter()
+            board.step(n_gen)
+            elapsed = time.perf_counter() - start
+        results.append({
+            "workers": n_workers,
+            "generations_per_s": n_gen / elapsed,
+            "cells_per_s": n * n * n_gen / elapsed,
+        })
+    for result in results:
+        result["speedup"] = result["generations_per_s"] / results[0]["generations_per_s"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel Game of Life scaling benchmark")
+    parser.add_argument("--n", type=int, default=4096, help="board size")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--backend", default="process", choices=["process", "thread"])
+    args = parser.parse_args()
+
+    # check against the single-process engine first
+    model = Game_of_Life(n=200, random_state=0, engine="vectorized")
+    with ParallelGameOfLife(initial_grid=model.grid, n_workers=3, backend=args.backend) as board:
+        board.step(50)
+        for i in range(50):
+            model.step()
+        assert np.array_equal(board.grid, model.grid == 1)
+
+    print("cpus: {}".format(mp.cpu_count()))
+    for result in benchmark(args.n, args.workers, args.generations, args.backend):
+        print("{:3d} workers: {:8.2f} generations/s, {:.2e} cells/s, speedup {:.2f}x".format(
+            result["workers"], result["generations_per_s"], result["cells_per_s"],
+            result["speedup"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
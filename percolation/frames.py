@@ -0,0 +1,95 @@
+"""
+Frame recorder for PercolationSimulation.
+
+Frames are encoded to PNG straight from the integer lattice with a fixed palette, on a
+background thread, so recording does not build a matplotlib figure per frame and the
+simulation only pays for copying the lattice into a queue.
+"""
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+
+_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if _COMMON not in sys.path:
+    sys.path.insert(0, _COMMON)
+
+from png_writer import write_png
+
+# Colours of plot_percolation and plot_percolation_end, indexed by site value:
+# blocked, empty, filled
+FLOW_PALETTE = np.array([[0, 0, 0], [102, 102, 102], [95, 152, 255]], dtype=np.uint8)
+PERCOLATED_PALETTE = np.array([[0, 0, 0], [102, 102, 102], [0, 255, 0]], dtype=np.uint8)
+BLOCKED_PALETTE = np.array([[0, 0, 0], [102, 102, 102], [255, 0, 0]], dtype=np.uint8)
+
+
+class FrameRecorder:
+    """
+    Observer that writes percolation frames to numbered PNG files on a background
+    thread. Attach it with PercolationSimulation(recorder=...), and close it (or use it
+    as a context manager) to wait for the queued frames to be written.
+    """
+
+    def __init__(self, out_dir="private_dump/percolation", scale=1, max_queue=256):
+        """
+        Args:
+            out_dir (str): directory the frames are written to, created if missing
+            scale (int): every site is drawn as a scale x scale block of pixels
+            max_queue (int): number of frames that can wait to be written before the
+                simulation blocks
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.scale = scale
+        self.n_frames = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._thread.start()
+
+    def _put(self, grid, palette):
+        if self._error is not None:
+            raise self._error
+        path = os.path.join(self.out_dir, "frame" + str(self.n_frames).zfill(4) + ".png")
+        self.n_frames += 1
+        # copy, since the simulation keeps writing to the lattice
+        self._queue.put((path, np.array(grid, dtype=np.uint8), palette))
+
+    def frame(self, grid):
+        """Queue a frame of a lattice that is still filling"""
+        self._put(grid, FLOW_PALETTE)
+
+    def final(self, grid, percolated):
+        """Queue the final lattice, with filled sites in green if it percolated"""
+        self._put(grid, PERCOLATED_PALETTE if percolated else BLOCKED_PALETTE)
+
+    def _write_frames(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, grid, palette = item
+            try:
+                # values above 2 are drawn as filled, like imshow with vmax=2
+                rgb = palette[np.minimum(grid, 2)]
+                if self.scale > 1:
+                    rgb = np.repeat(np.repeat(rgb, self.scale, axis=0), self.scale, axis=1)
+                write_png(path, rgb)
+            except Exception as error:
+                self._error = error
+
+    def close(self):
+        """Wait until every queued frame is written"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
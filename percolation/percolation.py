@@ -1,7 +1,53 @@
+import os
+import sys
+
 import numpy as np
+
+_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if _COMMON not in sys.path:
+    sys.path.insert(0, _COMMON)
+
+from random_fill import random_choice
+
+
+class _UnionFind:
+    """
+    Weighted union-find (disjoint set) with path compression. Sites are integers
+    0 ... size-1, and find() runs in near-constant amortized time.
+    """
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            # path halving: point every other site on the path to its grandparent
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        # hang the smaller tree below the larger one
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+
 class PercolationSimulation:
 
-    def __init__(self, n=100, p=0.5, grid=None, random_state=None):
+    # Tracer timing percolation.flow_row and percolation.poll_neighbors
+    tracer = None
+    # ResultCache of percolate(), skipped for unseeded runs and runs with a recorder
+    cache = None
+
+    def __init__(self, n=100, p=0.5, grid=None, random_state=None, engine="flow",
+                 recorder=None, memory="default"):
         """
         Initialize a PercolationSimulation object.
 
@@ -12,20 +58,33 @@ class PercolationSimulation:
                 ensure reproducibility across random simulations. The default value of None
                 will use the current state of the random number generator without resetting
                 it.
+            engine (str): "flow" fills the lattice row by row, "union_find" joins
+                neighboring open sites with a union-find and checks whether the top and
+                bottom rows end up in the same cluster
+            recorder (FrameRecorder): optional observer that receives a frame after
+                every filled row and the final lattice. Nothing is rendered if it is None.
+            memory (str): "default" stores the lattice as int64. "lean" stores it as
+                uint8, which holds every site state (blocked, open and filled).
         """
+        if engine not in ("flow", "union_find"):
+            raise ValueError("engine must be 'flow' or 'union_find', got {}".format(engine))
+        if memory not in ("default", "lean"):
+            raise ValueError("memory must be 'default' or 'lean', got {}".format(memory))
 
         self.random_state = random_state # the random seed
+        self.engine = engine
+        self.recorder = recorder
+        self.memory = memory
 
         # Initialize a random grid if one is not provided. Otherwise, use the provided
         # grid.
         if grid is None:
             self.n = n
             self.p = p
-            self.grid = np.zeros((n, n))
             self._initialize_grid()
         else:
             assert len(np.unique(np.ravel(grid))) <= 2, "Grid must only contain 0s and 1s"
-            self.grid = grid.astype(int)
+            self.grid = grid.astype(np.uint8 if memory == "lean" else int)
             # override numbers if grid is provided
             self.n = grid.shape[0]
             self.p = 1 - np.mean(grid)
@@ -51,8 +110,13 @@ class PercolationSimulation:
         input/outputs because it's a public method
         """
         np.random.seed(self.random_state)
-        self.grid = np.random.choice([1, 0], size=(self.n, self.n), p=[1-self.p, self.p])
-        self.grid = np.pad(self.grid, (1, 1), 'constant', constant_values = (0, 0))
+        if self.memory == "lean":
+            # draw straight into the inside of the padded lattice
+            self.grid = np.zeros((self.n + 2, self.n + 2), dtype=np.uint8)
+            random_choice([1, 0], self.grid[1:-1, 1:-1], p=[1-self.p, self.p])
+        else:
+            self.grid = np.random.choice([1, 0], size=(self.n, self.n), p=[1-self.p, self.p])
+            self.grid = np.pad(self.grid, (1, 1), 'constant', constant_values = (0, 0))
         self.grid_filled = np.copy(self.grid)
 
     def _poll_neighbors(self, i, j):
@@ -60,20 +124,29 @@ class PercolationSimulation:
         Check whether there is a filled site adjacent to a site at coordinates i, j in 
         self.grid_filled. Respects boundary conditions.
         """
-        enforced_boundary_grid = self.grid_filled >= 2
-        return any([enforced_boundary_grid[i-1, j], enforced_boundary_grid[i, j+1], enforced_boundary_grid[i, j-1]])
-
-    def _flow(self, rs):
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.clock()
+        # only the three neighbors are compared, instead of the whole lattice
+        grid_filled = self.grid_filled
+        filled = grid_filled[i-1, j] >= 2 or grid_filled[i, j+1] >= 2 or grid_filled[i, j-1] >= 2
+        if tracer is not None:
+            tracer.record("percolation.poll_neighbors", start)
+        return filled
+
+    def _flow(self):
         """
         Run a percolation simulation using recursion
 
         This method writes to the grid and grid_filled attributes, but it does not
         return anything. In other languages like Java or C, this method would return
-        void
+        void. If a recorder is attached, it gets a frame after every row.
         """
         self.grid_filled[0, :] = 2
+        tracer = self.tracer
         for i in range(self.grid_filled.shape[0]):
-            out_path = "private_dump/percolation/frame" + str(rs*53+i).zfill(4) + ".png"
+            if tracer is not None:
+                start = tracer.clock()
             open_cells = np.where(self.grid_filled[i]==1)[0]
             if len(open_cells) != 0:
                 for open_coords in open_cells:
@@ -82,49 +155,187 @@ class PercolationSimulation:
                 for invert_coords in open_cells[np.argsort(-open_cells)]:
                     if self._poll_neighbors(i, invert_coords):
                         self.grid_filled[i, invert_coords] += 1
-            plt.figure()
-            plot_percolation(self.grid_filled)
-            plt.grid(False)
-            plt.axis('off')
+            if tracer is not None:
+                tracer.record("percolation.flow_row", start)
+            if self.recorder is not None:
+                self.recorder.frame(self.grid_filled)
+
+    def _union_find(self):
+        """
+        Fill every open site connected to the top row, in any direction, using a
+        union-find over the open sites. A virtual node stands for the row above the
+        lattice, so the filled sites are the ones in the same set as that node. This
+        takes near-linear time in the number of sites.
+
+        There is no virtual bottom node here: it would join every open bottom site to
+        the top as soon as the lattice spans, and those sites would be filled even if
+        they are not connected to anything. The lattice spans if a bottom site is filled.
 
-            plt.savefig(out_path, bbox_inches='tight', pad_inches=0.0)
-            plt.close()
-        
+        Like _flow, this writes to grid_filled: filled sites are set to 2.
+        """
+        open_sites = self.grid[1:-1, 1:-1] == 1
+        n = open_sites.shape[0]
+        top = n * n
+        sets = _UnionFind(n * n + 1)
+        index = np.arange(n * n).reshape(n, n)
+        # pairs of neighboring open sites, to the right and below
+        right = open_sites[:, :-1] & open_sites[:, 1:]
+        down = open_sites[:-1, :] & open_sites[1:, :]
+        for a, b in zip(index[:, :-1][right], index[:, 1:][right]):
+            sets.union(a, b)
+        for a, b in zip(index[:-1, :][down], index[1:, :][down]):
+            sets.union(a, b)
+        for a in index[0][open_sites[0]]:
+            sets.union(top, a)
+
+        top_root = sets.find(top)
+        roots = np.array([sets.find(a) for a in range(n * n)]).reshape(n, n)
+        self.grid_filled[0, :] = 2
+        self.grid_filled[1:-1, 1:-1][open_sites & (roots == top_root)] = 2
 
-    def percolate(self, rs):
+    def percolate(self):
         """
         Initialize a random lattice and then run a percolation simulation. Report results
+
+        With a cache attached, the lattices and the result of a run with the same n, p,
+        random_state and engine are loaded instead. Runs with a recorder are never
+        cached, since the recorder needs every row, and neither are runs without a
+        random_state, since np.random.seed(None) draws a fresh seed.
         """
+        cache = self.cache
+        if self.recorder is not None or self.random_state is None:
+            cache = None
+        if cache is not None:
+            params = {"n": self.n, "p": self.p, "random_state": self.random_state,
+                      "engine": self.engine}
+            key = cache.key(self, params)
+            result = cache.load(key)
+            if result is not None:
+                dtype = np.uint8 if self.memory == "lean" else int
+                self.grid = result["grid"].astype(dtype)
+                self.grid_filled = result["grid_filled"].astype(dtype)
+                cache.restore_rng(result)
+                return bool(result["percolated"])
 
         self._initialize_grid()
-        self._flow(rs)
-        self.grid_filled = self.grid_filled[1:-1, 1:-1]
-        out_path = "private_dump/percolation/frame" + str((rs+1)*52).zfill(4) + ".png"
-        plt.grid(False)
-        plt.axis('off')
-
-        if any(self.grid_filled[-1, :]>=2):
-            plot_percolation_end(self.grid_filled, True)
-            plt.grid(False)
-            plt.axis('off')
-            plt.savefig(out_path, bbox_inches='tight', pad_inches=0.0)
-            plt.close('all')
-            return True
+        if self.engine == "union_find":
+            self._union_find()
         else:
-            plot_percolation_end(self.grid_filled, False)
-            plt.grid(False)
-            plt.axis('off')
-            plt.savefig(out_path, bbox_inches='tight', pad_inches=0.0)
-            plt.close('all')
-            return False
-
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+            self._flow()
+        self.grid_filled = self.grid_filled[1:-1, 1:-1]
+        percolated = bool(any(self.grid_filled[-1, :]>=2))
+        if self.recorder is not None:
+            self.recorder.final(self.grid_filled, percolated)
+        if cache is not None:
+            cache.store(key, dict(
+                grid=self.grid.astype(np.uint8), grid_filled=self.grid_filled.astype(np.uint8),
+                percolated=percolated, **cache.rng_state()
+            ))
+        return percolated
+
+    def bytes_per_cell(self):
+        """
+        Memory held by the lattice and the filled lattice, per site of the n x n lattice
+        """
+        arrays = [self.grid]
+        if not np.shares_memory(self.grid_filled, self.grid):
+            arrays.append(self.grid_filled)
+        return sum(a.nbytes for a in arrays) / (self.n * self.n)
+
+    def _open_sites(self):
+        """
+        Boolean array of the open sites of the lattice, without the blocked border that
+        _initialize_grid pads the lattice with.
+        """
+        if self.grid.shape[0] == self.n + 2:
+            return self.grid[1:-1, 1:-1] == 1
+        return self.grid == 1
+
+    def clusters(self):
+        """
+        Label the clusters of open sites (connected through their four neighbors) and
+        measure them, with a vectorized Hoshen-Kopelman scheme.
+
+        Every horizontal run of open sites gets a provisional label in one pass over
+        the lattice. Runs that touch a run in the row above are equivalent, and the
+        equivalences are resolved in a compact label-equivalence array (one entry per
+        run) by repeatedly pointing the larger of two equivalent labels at the smaller
+        and then compressing the pointers. Nothing is recursive, so this works on
+        lattices of 4096 x 4096 and larger.
+
+        Returns:
+            clusters (dict):
+                "labels": int32 array with the cluster of every site, 1 ... n_clusters,
+                    and 0 for blocked sites
+                "sizes": number of sites in each cluster, sizes[k - 1] for label k
+                "size_histogram": size_histogram[s] is the number of clusters of size s
+                "largest_fraction": fraction of all sites in the largest cluster
+                "mean_size": mean cluster size sum(s^2) / sum(s) over the clusters that
+                    do not span the lattice
+                "spanning_mask": boolean array of the sites in clusters that connect
+                    the top row to the bottom row
+        """
+        open_sites = self._open_sites()
+        shape = open_sites.shape
+
+        # provisional labels: one per horizontal run of open sites
+        run_starts = open_sites.copy()
+        run_starts[:, 1:] &= ~open_sites[:, :-1]
+        runs = np.cumsum(run_starts.ravel(), dtype=np.int32).reshape(shape)
+        runs[~open_sites] = 0
+        n_runs = int(runs.max()) if runs.size else 0
+
+        # vertically touching runs are equivalent. Only the first column of each
+        # overlap is kept, since the rest of the overlap links the same two runs.
+        touching = open_sites[:-1] & open_sites[1:]
+        first = touching.copy()
+        first[:, 1:] &= ~touching[:, :-1]
+        upper, lower = runs[:-1][first], runs[1:][first]
+
+        equivalent = np.arange(n_runs + 1, dtype=np.int32)
+        while len(upper) != 0:
+            root_upper, root_lower = equivalent[upper], equivalent[lower]
+            unresolved = root_upper != root_lower
+            if not np.any(unresolved):
+                break
+            upper, lower = upper[unresolved], lower[unresolved]
+            root_upper, root_lower = root_upper[unresolved], root_lower[unresolved]
+            np.minimum.at(
+                equivalent, np.maximum(root_upper, root_lower), np.minimum(root_upper, root_lower)
+            )
+            # point every label straight at its root
+            while True:
+                compressed = equivalent[equivalent]
+                if np.array_equal(compressed, equivalent):
+                    break
+                equivalent = compressed
+
+        # renumber the roots 1 ... n_clusters. Label 0 (blocked) is its own root and
+        # stays 0.
+        roots, final = np.unique(equivalent, return_inverse=True)
+        labels = final.astype(np.int32)[runs]
+
+        sizes = np.bincount(labels.ravel(), minlength=len(roots))[1:]
+        spanning = np.intersect1d(labels[0][labels[0] > 0], labels[-1][labels[-1] > 0])
+        spanning_mask = np.isin(labels, spanning)
+        finite = np.delete(sizes, spanning - 1)
+        return {
+            "labels": labels,
+            "sizes": sizes,
+            "size_histogram": np.bincount(sizes),
+            "largest_fraction": sizes.max() / open_sites.size if len(sizes) else 0.0,
+            "mean_size": np.sum(finite.astype(float) ** 2) / max(np.sum(finite), 1),
+            "spanning_mask": spanning_mask,
+        }
+
+
 def plot_percolation(mat):
     """
     Plots a percolation matrix, where 0 indicates a blocked site, 1 indicates an empty 
     site, and 2 indicates a filled site
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
     cvals  = [0, 1, 2]
     colors = [(0, 0, 0), (0.4, 0.4, 0.4), (0.372549, 0.596078, 1)]
 
@@ -139,6 +350,8 @@ def plot_percolation_end(mat, status):
     """
     If percolated a it would turn the screen to green
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
     cvals  = [0, 1, 2]
     if status:
         colors = [(0, 0, 0), (0.4, 0.4, 0.4), (0.0, 1, 0)]
@@ -153,15 +366,93 @@ def plot_percolation_end(mat, status):
     plt.axis('off')
 
 
-rs = 1234
-for rs in range(0, 10):
-    model = PercolationSimulation(n=50, random_state=rs, p=0.4)
-    print(model.percolate(rs))
-    plt.figure()
-    plt.grid(False)
-    plt.axis('off')
+def newman_ziff(n, random_state=None):
+    """
+    Open the sites of an n x n lattice one at a time in a random order, joining each new
+    site to its open neighbors with a union-find (Newman and Ziff, 2000). A single pass
+    gives the spanning state of the lattice at every occupation level.
+
+    Args:
+        n (int): number of rows and columns in the lattice
+        random_state (int): random seed for numpy's random number generator
+
+    Returns:
+        spans (np.ndarray): spans[k] is 1 if the lattice with its first k sites open
+            has an open path from the top row to the bottom row, for k = 0 ... n * n
+    """
+    np.random.seed(random_state)
+    order = np.random.permutation(n * n)
+    top, bottom = n * n, n * n + 1
+    sets = _UnionFind(n * n + 2)
+    is_open = np.zeros(n * n, dtype=bool)
+    spans = np.zeros(n * n + 1, dtype=np.int64)
+    for k, site in enumerate(order.tolist()):
+        is_open[site] = True
+        i, j = divmod(site, n)
+        if i == 0:
+            sets.union(site, top)
+        if i == n - 1:
+            sets.union(site, bottom)
+        for neighbor, inside in ((site - n, i > 0), (site + n, i < n - 1),
+                                 (site - 1, j > 0), (site + 1, j < n - 1)):
+            if inside and is_open[neighbor]:
+                sets.union(site, neighbor)
+        if sets.find(top) == sets.find(bottom):
+            spans[k + 1:] = 1
+            break
+    return spans
+
+
+def spanning_probability(n, pvals, n_reps=100, random_state=None):
+    """
+    Percolation probability for every blocking probability p, from n_reps Newman-Ziff
+    passes instead of independent simulations at each p.
+
+    The spanning probability Q(k) with exactly k open sites is averaged over the
+    passes, and then weighted by the binomial probability of having k open sites when
+    every site is open with probability 1 - p.
+
+    Args:
+        n (int): number of rows and columns in the lattice
+        pvals (np.ndarray): blocking probabilities, like p in PercolationSimulation
+        n_reps (int): number of Newman-Ziff passes
+        random_state (int): random seed for numpy's random number generator
+
+    Returns:
+        probability (np.ndarray): percolation probability at every p in pvals
+        spans (np.ndarray): Q(k), the spanning probability at every occupation level
+    """
+    np.random.seed(random_state)
+    seeds = np.random.randint(0, 2**31 - 1, size=n_reps)
+    spans = np.mean([newman_ziff(n, seed) for seed in seeds], axis=0)
+
+    n_sites = n * n
+    k = np.arange(n_sites + 1)
+    log_factorial = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, n_sites + 1)))))
+    log_binomial = log_factorial[n_sites] - log_factorial[k] - log_factorial[n_sites - k]
+    probability = list()
+    for p in pvals:
+        q = 1 - p # probability of a site being open
+        if q <= 0:
+            weights = (k == 0).astype(float)
+        elif q >= 1:
+            weights = (k == n_sites).astype(float)
+        else:
+            weights = np.exp(log_binomial + k * np.log(q) + (n_sites - k) * np.log(1 - q))
+        probability.append(np.sum(weights * spans))
+    return np.array(probability), spans
+
+
+if __name__ == "__main__":
+    from frames import FrameRecorder
 
-    plot_percolation(model.grid_filled)
+    # every run saves its filling rows and, as its last frame, the end-of-run lattice
+    # with the spanning cluster in green or the blocked one in red
+    with FrameRecorder("private_dump/percolation") as recorder:
+        for rs in range(0, 10):
+            model = PercolationSimulation(n=50, random_state=rs, p=0.4, recorder=recorder)
+            print(model.percolate())
+    print("{} frames written to {}".format(recorder.n_frames, recorder.out_dir))
 
 # model = PercolationSimulation(n=20, random_state=rs, p=0.4)
 # print(model.percolate())
@@ -180,6 +471,8 @@ for rs in range(0, 10):
 # # plt.show()
 
 
+# # The sweep below is now run in parallel by sweep.py, or in a single Newman-Ziff pass
+# # per replicate by spanning_probability(30, pvals, n_reps)
 # # Import William's solution
 # #from solutions.percolation import PercolationSimulation
 
@@ -0,0 +1,238 @@
+"""
+Parallel parameter sweep for estimating the percolation threshold.
+
+Every (n, p, replicate) combination is an independent job with its own seed, derived
+deterministically from a base seed, so a sweep gives the same table no matter how the
+jobs are spread over the worker processes. Results are appended to a CSV table as soon
+as each job finishes, and a sweep that is started again with the same output path skips
+the jobs already in the table. A job is identified by its n, p, replicate and seed, so
+a sweep over another p grid or with another base seed runs its own jobs, and only
+summarizes those.
+
+The jobs use the union-find engine by default, since the flow engine misses clusters
+that have to flow back upward to span the lattice, which biases the estimate.
+
+Example:
+    python sweep.py --sizes 20 30 50 --n-p 25 --reps 200 --out sweep.csv
+"""
+import argparse
+import csv
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from percolation import PercolationSimulation
+
+FIELDS = ["n", "p_index", "p", "replicate", "seed", "engine", "percolated"]
+
+# correlation length exponent of two-dimensional percolation
+NU = 4 / 3
+
+
+def job_seed(seed, n, p_index, replicate):
+    """Deterministic random_state of one job, independent of the other jobs"""
+    return int(np.random.SeedSequence([seed, n, p_index, replicate]).generate_state(1)[0])
+
+
+def _run_job(job):
+    """Run a single percolation simulation. This runs in a worker process."""
+    n, p_index, p, replicate, seed, engine = job
+    model = PercolationSimulation(n=n, p=p, random_state=seed, engine=engine)
+    return n, p_index, p, replicate, seed, engine, int(model.percolate())
+
+
+def job_key(n, p, replicate, seed, engine):
+    """What identifies a finished job in the table"""
+    return int(n), float(p), int(replicate), int(seed), engine
+
+
+def read_table(path):
+    """
+    Read the results written so far. Rows that can't be parsed, such as a line cut
+    short when a sweep was interrupted, are skipped.
+
+    Returns:
+        rows (list): one (n, p_index, p, replicate, seed, engine, percolated) tuple per
+            job
+    """
+    rows = list()
+    if not os.path.exists(path):
+        return rows
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is not None and reader.fieldnames != FIELDS:
+            raise ValueError("{} has columns {}, expected {}".format(
+                path, reader.fieldnames, FIELDS
+            ))
+        for row in reader:
+            try:
+                rows.append((
+                    int(row["n"]), int(row["p_index"]), float(row["p"]),
+                    int(row["replicate"]), int(row["seed"]), row["engine"],
+                    int(row["percolated"])
+                ))
+            except (TypeError, ValueError):
+                continue
+    return rows
+
+
+def summarize(rows, sizes, pvals):
+    """
+    Compute the percolation probability and its standard error for every (n, p), and
+    estimate p_c by finite-size scaling. Rows are matched to the columns by their p
+    value, and rows with a p that is not in pvals are ignored.
+
+    For each n, the p where the percolation probability crosses 1/2 is found by linear
+    interpolation. These crossings approach the threshold as p_c + a * n^(-1/nu), so a
+    straight line fitted against n^(-1/nu) gives p_c as its intercept. With a single
+    n, the crossing itself is returned.
+
+    Returns:
+        summary (dict): "probability" and "stderr" arrays of shape (len(sizes),
+            len(pvals)), the "crossings" for every n and the "p_c" estimate
+    """
+    sums = np.zeros((len(sizes), len(pvals)))
+    counts = np.zeros((len(sizes), len(pvals)))
+    size_index = {n: i for i, n in enumerate(sizes)}
+    p_column = {float(p): j for j, p in enumerate(pvals)}
+    for n, p_index, p, replicate, seed, engine, percolated in rows:
+        if n in size_index and p in p_column:
+            sums[size_index[n], p_column[p]] += percolated
+            counts[size_index[n], p_column[p]] += 1
+
+    probability = sums / np.maximum(counts, 1)
+    # the outcomes are 0/1, so the sample variance follows from the mean
+    variance = probability * (1 - probability) * counts / np.maximum(counts - 1, 1)
+    stderr = np.sqrt(variance / np.maximum(counts, 1))
+
+    crossings = np.full(len(sizes), np.nan)
+    for i in range(len(sizes)):
+        # percolation gets less likely as the blocking probability p grows
+        below = np.flatnonzero(probability[i] < 0.5)
+        if len(below) == 0 or below[0] == 0:
+            continue
+        j = below[0]
+        p0, p1 = pvals[j - 1], pvals[j]
+        P0, P1 = probability[i, j - 1], probability[i, j]
+        crossings[i] = p0 + (P0 - 0.5) * (p1 - p0) / (P0 - P1)
+
+    found = ~np.isnan(crossings)
+    if np.sum(found) >= 2:
+        x = np.asarray(sizes, dtype=float)[found] ** (-1 / NU)
+        slope, p_c = np.polyfit(x, crossings[found], 1)
+    elif np.sum(found) == 1:
+        p_c = crossings[found][0]
+    else:
+        p_c = np.nan
+
+    return {
+        "sizes": list(sizes),
+        "pvals": np.asarray(pvals),
+        "probability": probability,
+        "stderr": stderr,
+        "counts": counts,
+        "crossings": crossings,
+        "p_c": p_c,
+    }
+
+
+def _truncate_partial_line(path, chunk_size=4096):
+    """Cut off a last line left unfinished by an interrupted sweep"""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - chunk_size, 0)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+def run_sweep(sizes, pvals, n_reps, out_path, n_workers=None, seed=0,
+              engine="union_find"):
+    """
+    Run PercolationSimulation for every lattice size, blocking probability and
+    replicate on a pool of worker processes, and summarize the results.
+
+    Args:
+        sizes (list): lattice sizes n
+        pvals (list): blocking probabilities p
+        n_reps (int): number of replicates per (n, p)
+        out_path (str): CSV table the results are streamed to. Jobs already in the
+            table (same n, p, replicate and seed) are not run again, and rows of other
+            sweeps in the table are left out of the summary.
+        n_workers (int): number of worker processes, defaults to the number of CPUs
+        seed (int): base seed the job seeds are derived from
+        engine (str): PercolationSimulation engine of the jobs
+
+    Returns:
+        summary (dict): see summarize()
+    """
+    all_jobs = [
+        (n, p_index, float(p), replicate, job_seed(seed, n, p_index, replicate), engine)
+        for n in sizes
+        for p_index, p in enumerate(pvals)
+        for replicate in range(n_reps)
+    ]
+    if os.path.exists(out_path):
+        # drop a line cut short by an interrupted sweep, so the table stays valid
+        _truncate_partial_line(out_path)
+    done = {job_key(row[0], *row[2:6]) for row in read_table(out_path)}
+    jobs = [job for job in all_jobs if job_key(job[0], *job[2:]) not in done]
+
+    if jobs:
+        new_file = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+        with open(out_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(FIELDS)
+            with Pool(n_workers) as pool:
+                for result in pool.imap_unordered(_run_job, jobs, chunksize=8):
+                    writer.writerow(result)
+                    f.flush()
+
+    # only the rows of this sweep, once per job
+    wanted = {job_key(n, p, r, s, e) for n, i, p, r, s, e in all_jobs}
+    rows = list()
+    for row in read_table(out_path):
+        key = job_key(row[0], *row[2:6])
+        if key in wanted:
+            wanted.remove(key)
+            rows.append(row)
+    return summarize(rows, sizes, pvals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Percolation threshold sweep")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[30],
+                        help="lattice sizes n")
+    parser.add_argument("--p-min", type=float, default=0.0)
+    parser.add_argument("--p-max", type=float, default=1.0)
+    parser.add_argument("--n-p", type=int, default=25, help="number of p values")
+    parser.add_argument("--reps", type=int, default=200, help="replicates per (n, p)")
+    parser.add_argument("--out", default="sweep.csv", help="CSV table of results")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default="union_find", choices=["union_find", "flow"],
+                        help="PercolationSimulation engine")
+    args = parser.parse_args()
+
+    pvals = np.linspace(args.p_min, args.p_max, args.n_p)
+    summary = run_sweep(args.sizes, pvals, args.reps, args.out, args.workers, args.seed,
+                        args.engine)
+
+    for i, n in enumerate(summary["sizes"]):
+        print("n = {}".format(n))
+        for p, prob, err in zip(pvals, summary["probability"][i], summary["stderr"][i]):
+            print("  p = {:.4f}  P = {:.4f} +/- {:.4f}".format(p, prob, err))
+        print("  crossing P = 1/2 at p = {:.4f}".format(summary["crossings"][i]))
+    print("estimated p_c = {:.4f}".format(summary["p_c"]))
+
+
+if __name__ == "__main__":
+    main()
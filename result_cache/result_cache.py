@@ -0,0 +1,258 @@
+"""
+Persistent, content-addressed cache of simulation results.
+
+PercolationSimulation and AbelianSandpile have a cache class attribute that is None by
+default. Attach a ResultCache to a class (every instance uses it) or to a single
+instance, and repeated runs with the same key are read from disk instead of computed:
+
+    PercolationSimulation.percolate     keyed by n, p, random_state and engine
+    AbelianSandpile.simulate            keyed by the initial grid, the random state,
+                                        n_step, engine and history mode
+
+A key also holds the model class and a hash of the source file that defines it, so
+editing the model invalidates its old results. Every result is one compressed .npz
+file named after the SHA-256 of its key. The state of numpy's global random number
+generator after the run is stored with the result and restored on a hit, so code that
+draws random numbers after a cached run sees the same numbers as after a real one.
+
+The directory is bounded to max_bytes by evicting the least recently used results.
+Recency is the modification time of the file, which a hit refreshes, so it is shared
+by every process using the same directory.
+
+Example:
+    cache = ResultCache("~/.cache/cphy", max_bytes=2**30)
+    cache.attach(PercolationSimulation, AbelianSandpile)
+    ...
+    print(cache.stats())
+"""
+import hashlib
+import inspect
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+
+# bump when the layout of the stored results changes
+FORMAT_VERSION = 1
+
+
+class ResultCache:
+
+    def __init__(self, path="result_cache", max_bytes=2**30):
+        """
+        Args:
+            path (str): directory the results are stored in, created if needed
+            max_bytes (int): total size of the stored results above which the least
+                recently used ones are evicted
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._code_versions = dict()
+
+    def attach(self, *targets):
+        """Cache the results of the given classes or instances"""
+        for target in targets:
+            target.cache = self
+
+    @staticmethod
+    def detach(*targets):
+        """Stop caching the results of the given classes or instances"""
+        for target in targets:
+            if isinstance(target, type):
+                target.cache = None
+            else:
+                # fall back to the class attribute
+                target.__dict__.pop("cache", None)
+
+    def code_version(self, cls):
+        """SHA-256 of the source file defining cls"""
+        if cls not in self._code_versions:
+            with open(inspect.getsourcefile(cls), "rb") as f:
+                self._code_versions[cls] = hashlib.sha256(f.read()).hexdigest()
+        return self._code_versions[cls]
+
+    @staticmethod
+    def digest(array):
+        """SHA-256 of the dtype, shape and contents of an array"""
+        array = np.ascontiguousarray(array)
+        h = hashlib.sha256(str((array.dtype.str, array.shape)).encode())
+        h.update(array.data)
+        return h.hexdigest()
+
+    @staticmethod
+    def rng_state():
+        """numpy's global random state as a dict of arrays"""
+        kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return {
+            "rng_keys": keys,
+            "rng_pos": np.array(pos),
+            "rng_has_gauss": np.array(has_gauss),
+            "rng_cached_gaussian": np.array(cached_gaussian),
+        }
+
+    @staticmethod
+    def restore_rng(result):
+        """Set numpy's global random state from a result stored with rng_state()"""
+        np.random.set_state((
+            "MT19937", result["rng_keys"], int(result["rng_pos"]),
+            int(result["rng_has_gauss"]), float(result["rng_cached_gaussian"]),
+        ))
+
+    def rng_digest(self):
+        """Hash of numpy's global random state, for runs that draw from it unseeded"""
+        state = self.rng_state()
+        return hashlib.sha256(b"".join(
+            np.ascontiguousarray(state[name]).tobytes() for name in sorted(state)
+        )).hexdigest()
+
+    def key(self, model, params):
+        """
+        Content address of a result.
+
+        Args:
+            model: the model instance the result belongs to
+            params (dict): everything the result depends on, JSON serializable or
+                numpy scalars
+
+        Returns:
+            key (str): hex SHA-256 of the model class, its code version and params
+        """
+        cls = type(model)
+        description = {
+            "format": FORMAT_VERSION,
+            "class": cls.__module__ + "." + cls.__qualname__,
+            "code": self.code_version(cls),
+            "params": params,
+        }
+        text = json.dumps(description, sort_keys=True,
+                          default=lambda value: value.item())
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def load(self, key):
+        """
+        Returns:
+            result (dict): the stored arrays, or None if the key is not in the cache
+        """
+        try:
+            with np.load(self._file(key)) as data:
+                result = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError, zipfile.BadZipFile):
+            # missing, or evicted or half written by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(self._file(key)) # most recently used now
+        except FileNotFoundError:
+            pass
+        return result
+
+    def store(self, key, arrays):
+        """
+        Store a result, then evict the least recently used results while the cache
+        is larger than max_bytes. The file is written under a temporary name and moved
+        in place, so readers never see half a result.
+
+        Args:
+            key (str): content address from key()
+            arrays (dict): name -> np.ndarray or scalar
+        """
+        tmp = self._file(key) + ".{}.tmp".format(os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, self._file(key))
+        self.stores += 1
+        self._evict()
+
+    def _entries(self):
+        """(modification time, size, path) of every stored result"""
+        entries = list()
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    try:
+                        info = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        # the newest result is kept even if it alone is over the bound
+        for mtime, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    @property
+    def nbytes(self):
+        """Total size of the stored results"""
+        return sum(size for mtime, size, path in self._entries())
+
+    def __len__(self):
+        return len(self._entries())
+
+    def clear(self):
+        """Remove every stored result"""
+        for mtime, size, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns:
+            stats (dict): "hits", "misses", "stores" and "evictions" of this instance,
+                and the "entries" and "bytes" stored in the directory
+        """
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for mtime, size, path in entries),
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.join(root, "percolation"))
+    sys.path.insert(0, os.path.join(root, "abelian_sandpile"))
+    from abelian_sandpile import AbelianSandpile
+    from percolation import PercolationSimulation
+
+    cache = ResultCache(tempfile.mkdtemp(), max_bytes=50 * 2**20)
+    cache.attach(PercolationSimulation, AbelianSandpile)
+    for attempt in ("cold", "warm"):
+        start = time.perf_counter()
+        spans = [PercolationSimulation(n=100, p=0.4, random_state=rs).percolate()
+                 for rs in range(20)]
+        model = AbelianSandpile(n=64, random_state=0, history="compact")
+        model.simulate(5000)
+        print("{}: {:.2f} s, {} of 20 lattices percolate, {} avalanches".format(
+            attempt, time.perf_counter() - start, sum(spans), model.history.n_events
+        ))
+    print(cache.stats())
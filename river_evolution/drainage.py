@@ -0,0 +1,257 @@
+"""
+Drainage network analysis of a height field, such as River_Evolution._total_height().
+
+Every cell drains to the neighbour of steepest descent among its eight neighbours (D8).
+The flow directions form a forest whose roots are the outlets, so upstream quantities
+can be accumulated by visiting the cells in topological order: a cell is only visited
+once every cell draining into it has been visited. The order is built level by level
+(Kahn's algorithm), every level is handled with a few array operations, and every cell
+is in exactly one level, so the work is linear in the number of cells.
+
+Like River_Evolution, the last row is the sink the water leaves through and the left
+and right edges wrap around.
+"""
+import numpy as np
+
+# (di, dj) of the eight neighbours, straight down first so it wins ties
+OFFSETS = [(1, 0), (1, -1), (1, 1), (0, -1), (0, 1), (-1, 0), (-1, -1), (-1, 1)]
+
+
+def flow_directions(height):
+    """
+    D8 flow directions.
+
+    A cell drains to the neighbour with the largest drop per unit distance. Cells on a
+    flat or in a pit, with no lower neighbour, drain straight down if the cell below
+    is not higher, as water does in River_Evolution. Cells of the last row are outlets.
+
+    Args:
+        height (np.ndarray): (rows, cols) height field
+
+    Returns:
+        receivers (np.ndarray): flat index of the cell every cell drains to, -1 for
+            outlets and pits, as an int64 array of the same shape as height
+    """
+    rows, cols = height.shape
+    # columns wrap around, so pad with the opposite edge column
+    padded = np.concatenate([height[:, -1:], height, height[:, :1]], axis=1)
+    best = np.zeros((rows, cols))
+    slope = np.empty((rows, cols))
+    # index into OFFSETS of the direction every cell drains in, -1 for none
+    direction = np.full((rows, cols), -1, dtype=np.int8)
+    for k, (di, dj) in enumerate(OFFSETS):
+        # cells whose neighbour (i+di, j+dj) is inside the grid
+        r0, r1 = max(0, -di), rows - max(0, di)
+        out = slope[r0:r1]
+        np.subtract(height[r0:r1], padded[r0+di:r1+di, 1+dj:1+dj+cols], out=out)
+        out /= np.hypot(di, dj)
+        np.copyto(direction[r0:r1], k, where=out > best[r0:r1])
+        np.maximum(best[r0:r1], out, out=best[r0:r1])
+
+    # flats and pits drain straight down when the cell below is not higher
+    np.copyto(direction[:-1], 0, where=(direction[:-1] == -1) & (height[1:] <= height[:-1]))
+    direction[-1] = -1
+
+    steps = np.array(OFFSETS + [(0, 0)])
+    di = steps[direction, 0]
+    dj = steps[direction, 1]
+    di += np.arange(rows)[:, None]
+    dj += np.arange(cols)
+    dj %= cols
+    receivers = di * cols + dj
+    receivers[direction == -1] = -1
+    return receivers
+
+
+def topological_levels(receivers):
+    """
+    Order the cells so that every cell comes after all the cells draining into it.
+
+    Returns:
+        order (np.ndarray): flat cell indices, sources first
+        starts (np.ndarray): order[starts[k]:starts[k+1]] is the k-th level. The cells
+            of a level do not drain into each other.
+    """
+    recv = receivers.ravel()
+    n_cells = len(recv)
+    indegree = np.bincount(recv[recv >= 0], minlength=n_cells)
+    frontier = np.flatnonzero(indegree == 0)
+    marker = np.zeros(n_cells, dtype=np.int64)
+    levels, starts, total = list(), [0], 0
+    while len(frontier):
+        levels.append(frontier)
+        total += len(frontier)
+        starts.append(total)
+        down = recv[frontier]
+        down = down[down >= 0]
+        np.subtract.at(indegree, down, 1)
+        ready = down[indegree[down] == 0]
+        # a cell with several inflows in this level shows up more than once, keep one
+        marker[ready] = np.arange(len(ready))
+        frontier = ready[marker[ready] == np.arange(len(ready))]
+    if total != n_cells:
+        raise ValueError("the flow directions contain a cycle")
+    return np.concatenate(levels), np.array(starts)
+
+
+def _step_lengths(receivers):
+    """Distance from every cell to its receiver, 0 for outlets"""
+    rows, cols = receivers.shape
+    recv = receivers.ravel()
+    index = np.arange(len(recv))
+    step = np.zeros(len(recv))
+    drains = recv >= 0
+    # a receiver in another row and another column is a diagonal neighbour
+    diagonal = (recv[drains] // cols != index[drains] // cols) & (recv[drains] % cols != index[drains] % cols)
+    step[drains] = np.where(diagonal, np.sqrt(2), 1.0)
+    return step
+
+
+def accumulate(receivers, order, starts):
+    """
+    Upstream contributing area and longest upstream flow path of every cell.
+
+    Returns:
+        area (np.ndarray): number of cells draining through every cell, itself included
+        length (np.ndarray): length of the longest flow path from a divide to the cell
+    """
+    recv = receivers.ravel()
+    step = _step_lengths(receivers)
+    area = np.ones(len(recv))
+    length = np.zeros(len(recv))
+    for k in range(len(starts) - 1):
+        cells = order[starts[k]:starts[k+1]]
+        down = recv[cells]
+        drains = down >= 0
+        cells, down = cells[drains], down[drains]
+        np.add.at(area, down, area[cells])
+        np.maximum.at(length, down, length[cells] + step[cells])
+    return area.reshape(receivers.shape), length.reshape(receivers.shape)
+
+
+def strahler_order(receivers, order, starts, channels):
+    """
+    Strahler order of the channel cells: sources have order 1, and where two or more
+    channels of the highest incoming order k meet, the order becomes k + 1.
+
+    Every cell keeps the largest and second largest incoming order. The order of a cell
+    is max(largest, second + 1), which is 1 without inflow, k with one channel of order
+    k flowing in, and k + 1 when two of them do.
+
+    Returns:
+        strahler (np.ndarray): order of every channel cell, 0 elsewhere
+        heads (np.ndarray): mask of the cells where a stream segment starts
+    """
+    recv = receivers.ravel()
+    channel = channels.ravel()
+    first = np.zeros(len(recv), dtype=np.int16)
+    second = np.zeros(len(recv), dtype=np.int16)
+    strahler = np.zeros(len(recv), dtype=np.int16)
+    for k in range(len(starts) - 1):
+        cells = order[starts[k]:starts[k+1]]
+        cells = cells[channel[cells]]
+        if len(cells) == 0:
+            continue
+        strahler[cells] = np.maximum(first[cells], second[cells] + 1)
+        down = recv[cells]
+        drains = down >= 0
+        cells, down = cells[drains], down[drains]
+        if len(cells) == 0:
+            continue
+        # the two largest orders flowing into every receiver from this level
+        values = strahler[cells]
+        sort = np.lexsort((-values, down))
+        down, values = down[sort], values[sort]
+        starts_of = np.flatnonzero(np.r_[True, down[1:] != down[:-1]])
+        target, top = down[starts_of], values[starts_of]
+        nxt = np.minimum(starts_of + 1, len(down) - 1)
+        runner_up = np.where(down[nxt] == target, values[nxt], 0)
+        runner_up[starts_of + 1 >= len(down)] = 0
+        old_first, old_second = first[target], second[target]
+        first[target] = np.maximum(old_first, top)
+        second[target] = np.maximum(np.minimum(old_first, top), np.maximum(old_second, runner_up))
+    heads = channel & (first < strahler)
+    return strahler.reshape(receivers.shape), heads.reshape(receivers.shape)
+
+
+def _ratio(orders, values):
+    """exp of the slope of log(values) against the order, nan with fewer than 2 orders"""
+    keep = values > 0
+    if np.sum(keep) < 2:
+        return np.nan
+    slope, intercept = np.polyfit(orders[keep], np.log(values[keep]), 1)
+    return np.exp(slope)
+
+
+def horton_statistics(receivers, strahler, heads, area):
+    """
+    Number of streams, mean stream length and mean basin area of every Strahler order,
+    and the Horton ratios fitted across orders.
+
+    Returns:
+        stats (dict): "orders", "counts", "mean_lengths", "mean_areas", and the
+            "bifurcation_ratio" N_k / N_(k+1), "length_ratio" L_(k+1) / L_k and
+            "area_ratio" A_(k+1) / A_k
+    """
+    recv = receivers.ravel()
+    order = strahler.ravel()
+    area = area.ravel()
+    step = _step_lengths(receivers)
+    n_orders = int(order.max())
+    orders = np.arange(1, n_orders + 1)
+    counts = np.bincount(order[heads.ravel()], minlength=n_orders + 1)[1:]
+    lengths = np.bincount(order, weights=step, minlength=n_orders + 1)[1:]
+    # a segment ends where its water enters a stream of another order, or leaves
+    channel = order > 0
+    down_order = np.where(recv >= 0, order[np.maximum(recv, 0)], 0)
+    ends = channel & (down_order != order)
+    end_area = np.bincount(order[ends], weights=area[ends], minlength=n_orders + 1)[1:]
+    n_ends = np.bincount(order[ends], minlength=n_orders + 1)[1:]
+    mean_lengths = lengths / np.maximum(counts, 1)
+    mean_areas = end_area / np.maximum(n_ends, 1)
+    return {
+        "orders": orders,
+        "counts": counts,
+        "mean_lengths": mean_lengths,
+        "mean_areas": mean_areas,
+        "bifurcation_ratio": 1 / _ratio(orders, counts.astype(float)),
+        "length_ratio": _ratio(orders, mean_lengths),
+        "area_ratio": _ratio(orders, mean_areas),
+    }
+
+
+def analyze(height, threshold=100):
+    """
+    Extract the drainage network of a height field and its scaling statistics.
+
+    Args:
+        height (np.ndarray): (rows, cols) height field
+        threshold (float): cells with at least this contributing area are channels
+
+    Returns:
+        network (dict): "receivers", "area", "length", "channels", "strahler" arrays,
+            the "hack_exponent" h of Hack's law L ~ A^h fitted over the channel cells,
+            and the Horton statistics of horton_statistics()
+    """
+    receivers = flow_directions(height)
+    order, starts = topological_levels(receivers)
+    area, length = accumulate(receivers, order, starts)
+    channels = area >= threshold
+    strahler, heads = strahler_order(receivers, order, starts, channels)
+
+    fit = channels & (length > 0)
+    if np.sum(fit) >= 2:
+        hack_exponent, intercept = np.polyfit(np.log(area[fit]), np.log(length[fit]), 1)
+    else:
+        hack_exponent = np.nan
+
+    network = {
+        "receivers": receivers,
+        "area": area,
+        "length": length,
+        "channels": channels,
+        "strahler": strahler,
+        "hack_exponent": hack_exponent,
+    }
+    network.update(horton_statistics(receivers, strahler, heads, area))
+    return network
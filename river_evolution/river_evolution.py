@@ -1,14 +1,61 @@
+import heapq
+import json
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+from drainage import analyze
+
+
 class River_Evolution:
 
-    def __init__(self, n=100, m=50, random_state=0):
+    # Tracer timing river.evolve and counting river.move
+    tracer = None
+
+    def __init__(self, n=100, m=50, random_state=0, engine="random", erosion_rate=0.0,
+                 deposition=0.5, erosion_interval=100, checkpoint_dir=None,
+                 checkpoint_interval=100_000, memory="default"):
         """
         Initialize a river evolution object
+
+        Args:
+            n (int): number of rows, row n is the sink the water drains into
+            m (int): number of columns, the left and right edges wrap around
+            random_state (int): random seed
+            engine (str): "random" moves the water of one random cell per step,
+                "synchronous" moves the water of every cell at once per step, and
+                "event" moves the water of one unstable cell per step, taken from a
+                priority queue of the cells that can flow
+            erosion_rate (float): terrain removed from a cell per unit of water that
+                flowed out of it. 0 keeps the terrain fixed.
+            deposition (float): fraction of the eroded terrain that settles in the
+                cell below, the rest is carried off by the water
+            erosion_interval (int): the terrain is updated every erosion_interval
+                steps, from the water that flowed in the meantime
+            checkpoint_dir (str): directory the state is saved to every
+                checkpoint_interval steps, as .npy files that can be memory-mapped
+            checkpoint_interval (int): number of steps between checkpoints
+            memory (str): "default" stores the grid and the flux as float64. "lean"
+                stores them as int32, since water moves in whole units, or as float32
+                if erosion makes the terrain fractional, in which case rounding can make
+                the run differ from the default one. The water history keeps 64 bits
+                since it sums the water over the whole run.
         """
+        if engine not in ("random", "synchronous", "event"):
+            raise ValueError("Unknown engine: {}".format(engine))
+        if memory not in ("default", "lean"):
+            raise ValueError("memory must be 'default' or 'lean', got {}".format(memory))
         self.random_state = random_state
         self.n = n
         self.m = m
+        self.engine = engine
+        self.erosion_rate = erosion_rate
+        self.deposition = deposition
+        self.erosion_interval = erosion_interval
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.memory = memory
+        self.step_count = 0
         self._initialize_grid()
     
     def _initialize_grid(self):
@@ -18,10 +65,20 @@ class River_Evolution:
         to set the random seed inside this method.
         """
         # np.random.seed(self.random_state)
-        self.grid = np.zeros((2, self.n+1, self.m))
+        if self.memory == "lean":
+            dtype = np.float32 if self.erosion_rate > 0 else np.int32
+            history_dtype = np.float64 if self.erosion_rate > 0 else np.int64
+        else:
+            dtype = history_dtype = np.float64
+        self.grid = np.zeros((2, self.n+1, self.m), dtype=dtype)
         # Setting a flat surface
         self.grid[0, ...] = 1
-        self.grid_history = self.grid.copy()
+        # the water of every cell at the end of every step, summed over the steps, the
+        # same for every engine, so grid_history[1] / steps is the mean water
+        self.grid_history = self.grid.astype(history_dtype)
+        # water that flowed out of every cell, since the start and since the last
+        # erosion update
+        self.flux = np.zeros((2, self.n+1, self.m), dtype=dtype)
 
     def _percipate(self):
         """
@@ -33,7 +90,7 @@ class River_Evolution:
         # i, j = (1, 1)
         # Add water to the cell
         self.grid[1, i, j] += 1
-        self.grid_history[]
+        return i, j
 
     def _total_height(self):
         """
@@ -41,8 +98,32 @@ class River_Evolution:
         """
         return self.grid[0]+self.grid[1]
 
+    def bytes_per_cell(self):
+        """
+        Memory held by the grid, the water history, the flux and the scratch buffers
+        of the engine, per cell of the (n + 1) x m lattice
+        """
+        arrays = [self.grid, self.grid_history, self.flux]
+        arrays += getattr(self, "_buffers", [])
+        for name in ("_height", "_queued", "_last_change"):
+            if hasattr(self, name):
+                arrays.append(getattr(self, name))
+        return sum(a.nbytes for a in arrays) / ((self.n + 1) * self.m)
+
+    def drainage_network(self, threshold=100):
+        """
+        Flow directions, contributing areas, channels and their Hack's law and Horton
+        statistics for the current total height. See drainage.analyze.
+
+        Args:
+            threshold (float): cells with at least this contributing area are channels
+        """
+        return analyze(self._total_height(), threshold)
+
     def _evolve(self):
-        
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.clock()
         # Calculate the total height of the grid
         # Randomly select a cell
         i = np.random.randint(0, self.n)
@@ -51,9 +132,11 @@ class River_Evolution:
         # i, j = (1, 1)
         # Artificially percipated water
         # self.grid[1, i, j] = 1
-        s = self._total_height()
+        # only the heights of the cell and its neighbors are needed, so they are read
+        # from the grid instead of building the whole height field
+        terrain, water = self.grid
         # Calculate the height of the cell
-        h = s[i, j]
+        h = terrain[i, j] + water[i, j]
         # Calculate the height of the neighbors
         neighbors = [(i+1, j), (i, j-1), (i, j+1)]
         # Check if the cell is on the edge
@@ -66,30 +149,308 @@ class River_Evolution:
         else:
         # Check if the cell is higher than the neighbors and if so, flow water to the neighbors
             for neighbor in neighbors:
-                h_n = s[neighbor]
-                while h>h_n:
+                h_n = terrain[neighbor] + water[neighbor]
+                # once erosion makes the terrain uneven, a dry cell can be higher
+                # than its neighbors, so only the water it holds can move
+                while h>h_n and water[i, j] >= 1:
                     n, m = neighbor
                     self.grid[1, i, j] -= 1
                     self.grid[1, n, m] += 1
-                    s = self._total_height()
-                    h = s[i, j]
+                    self.flux[:, i, j] += 1
+                    h = terrain[i, j] + water[i, j]
+                    if tracer is not None:
+                        tracer.count("river.move")
+        if tracer is not None:
+            tracer.record("river.evolve", start)
+
+    def _evolve_synchronous(self):
+        """
+        Move water out of every cell above the sink at once, with the same stencil as
+        _evolve: down (i+1, j) first, then left (i, j-1) and right (i, j+1), wrapping
+        around the edges. Water moves in whole units, so it is conserved exactly.
+
+        A cell sends half of its height difference (rounded up) down, and half of its
+        height difference (rounded down) to each side, but never more water than it
+        holds. Rounding down sideways keeps a unit from bouncing between two columns,
+        and rounding up downwards lets every unit reach the sink in the end. The halves
+        are taken with floor division, ceil(d / 2) = -((-d) // 2), so the same code
+        runs on integer and float grids.
+        """
+        n = self.n
+        height, drop, down, left, right = self._buffers
+        water = self.grid[1]
+        np.add(self.grid[0], water, out=height)
+
+        # water a cell can send down, as far as its neighbour is lower
+        np.subtract(height[1:], height[:n], out=drop)
+        np.floor_divide(drop, 2, out=down)
+        np.negative(down, out=down)
+        np.clip(down, 0, water[:n], out=down)
+
+        # drop[:, j] is height[:, j] - height[:, j-1], and height[:, j] - height[:, j+1]
+        # is -drop[:, j+1]
+        np.subtract(height[:n, 1:], height[:n, :-1], out=drop[:, 1:])
+        np.subtract(height[:n, 0], height[:n, -1], out=drop[:, 0])
+        np.floor_divide(drop, 2, out=left)
+        np.negative(drop[:, 1:], out=right[:, :-1])
+        np.negative(drop[:, 0], out=right[:, -1])
+        np.floor_divide(right, 2, out=right)
+
+        # whatever is left after flowing down is shared out left first, then right
+        np.subtract(water[:n], down, out=drop)
+        np.clip(left, 0, drop, out=left)
+        drop -= left
+        np.clip(right, 0, drop, out=right)
+
+        np.add(down, left, out=drop)
+        drop += right
+        water[:n] -= drop
+        self.flux[:, :n] += drop
+        water[1:] += down
+        water[:n, :-1] += left[:, 1:]
+        water[:n, -1] += left[:, 0]
+        water[:n, 1:] += right[:, :-1]
+        water[:n, 0] += right[:, -1]
+
+    def _flows(self, i, j):
+        """
+        Units of water cell (i, j) sends down, left and right, with the same rule as
+        _evolve_synchronous, read from the cached height field.
+        """
+        height = self._height
+        h = height[i, j]
+        w = self.grid[1, i, j]
+        # ceil(d / 2) = -((-d) // 2)
+        down = min(max(-((height[i+1, j] - h) // 2), 0), w)
+        left = min(max((h - height[i, j-1]) // 2, 0), w - down)
+        right = min(max((h - height[i, (j+1) % self.m]) // 2, 0), w - down - left)
+        return down, left, right
+
+    def _push(self, i, j):
+        """Queue cell (i, j) if it can flow and is not queued already"""
+        if i >= self.n or self._queued[i, j]:
+            return
+        if any(self._flows(i, j)):
+            self._queued[i, j] = True
+            # highest cells first, like water running off the top of the terrain
+            heapq.heappush(self._queue, (-self._height[i, j], i, j))
+
+    def _move(self, i, j, amount, step):
+        """Change the water of a cell, keeping the height field and history up to date"""
+        # water before the change was there at the end of steps last+1 .. step-1
+        self.grid_history[1, i, j] += self.grid[1, i, j] * (step - 1 - self._last_change[i, j])
+        self._last_change[i, j] = step - 1
+        self.grid[1, i, j] += amount
+        self._height[i, j] += amount
+
+    def _relax(self, i, j, step):
+        """Move the water of cell (i, j) and queue the cells that may now flow"""
+        m = self.m
+        down, left, right = self._flows(i, j)
+        self.flux[:, i, j] += down + left + right
+        self._move(i, j, -(down + left + right), step)
+        self._move(i+1, j, down, step)
+        self._move(i, (j-1) % m, left, step)
+        self._move(i, (j+1) % m, right, step)
+        # the receivers got higher, and the cell itself got lower, so the cells
+        # flowing into it (from above and from the sides) may be unstable now
+        for a, b in ((i, j), (i+1, j), (i, (j-1) % m), (i, (j+1) % m), (i-1, j)):
+            if a >= 0:
+                self._push(a, b)
+
+    def _start_events(self):
+        """Set up the bookkeeping of the event engine"""
+        self._queued = np.zeros((self.n, self.m), dtype=bool)
+        self._queue = list()
+        self._last_change = np.zeros(
+            (self.n+1, self.m), dtype=np.int32 if self.memory == "lean" else np.int64
+        )
+        self._queue_unstable()
+
+    def _queue_unstable(self):
+        """Rebuild the height field and the queue of unstable cells from the grid"""
+        n = self.n
+        # entries queued before hold heights of the old terrain
+        self._queue.clear()
+        self._queued[...] = False
+        self._height = self._total_height()
+        water = self.grid[1, :n]
+        height = self._height
+        # cells with water that are above the cell below, or 2 above a side cell
+        unstable = (height[:n] > height[1:]) | (height[:n] - np.roll(height[:n], 1, axis=1) >= 2)
+        unstable |= height[:n] - np.roll(height[:n], -1, axis=1) >= 2
+        unstable &= water >= 1
+        for i, j in zip(*np.nonzero(unstable)):
+            self._push(i, j)
+
+    def _flush_history(self, step):
+        """Add the water of the cells that did not change since their last move"""
+        self.grid_history[1] += self.grid[1] * (step - self._last_change)
+        self._last_change[...] = step
+
+    def _run_events(self, n_steps):
+        """
+        Event-driven version of run(). Every step relaxes the highest queued cell, so no
+        step is spent on a cell at equilibrium. Queue entries of cells that stopped
+        being unstable while they waited are dropped and counted as skipped.
+        """
+        self._start_events()
+        self.n_relaxations = 0
+        self.n_skipped = 0
+        for step in range(1, n_steps + 1):
+            if np.random.rand() < 0.5:
+                i, j = self._percipate()
+                # undo _percipate's change so _move can account for it
+                self.grid[1, i, j] -= 1
+                self._move(i, j, 1, step)
+                self._push(i, j)
+            while self._queue:
+                h, i, j = heapq.heappop(self._queue)
+                self._queued[i, j] = False
+                if any(self._flows(i, j)):
+                    self._relax(i, j, step)
+                    self.n_relaxations += 1
+                    break
+                self.n_skipped += 1
+            if self._end_step(step):
+                # the terrain changed, so every height and the queue are out of date
+                self._queue_unstable()
+        # water that did not change since its last move counts for the remaining steps
+        self._flush_history(n_steps)
+        return self.grid[1]
+
+    def _erode(self):
+        """
+        Lower the terrain of every cell in proportion to the water that flowed out of
+        it since the last update. Part of the removed terrain settles in the cell below,
+        the rest (and everything eroded just above the sink) is carried away.
+        """
+        n = self.n
+        terrain = self.grid[0]
+        eroded = np.minimum(self.erosion_rate * self.flux[1, :n], terrain[:n])
+        terrain[:n] -= eroded
+        terrain[1:n] += self.deposition * eroded[:-1]
+        self.flux[1] = 0
+
+    def _end_step(self, step=None):
+        """
+        Count a finished step, and update the terrain and save a checkpoint when they
+        are due.
+
+        Args:
+            step (int): step number within the current run of the event engine, used to
+                bring its lazily accumulated history up to date before a checkpoint
+
+        Returns:
+            eroded (bool): whether the terrain changed
+        """
+        self.step_count += 1
+        eroded = False
+        if self.erosion_rate > 0 and self.step_count % self.erosion_interval == 0:
+            self._erode()
+            eroded = True
+        if self.checkpoint_dir is not None and self.step_count % self.checkpoint_interval == 0:
+            if step is not None:
+                self._flush_history(step)
+            self.checkpoint()
+        return eroded
+
+    def checkpoint(self, path=None):
+        """
+        Save the grid, the water history and the flux accumulators to .npy files in
+        path (defaults to checkpoint_dir), together with the parameters, the step
+        count and the random state in state.json. The arrays are written to temporary
+        files first and moved in place, so an interrupted checkpoint leaves the
+        previous one intact.
+        """
+        if path is None:
+            path = self.checkpoint_dir
+        os.makedirs(path, exist_ok=True)
+        arrays = {"grid": self.grid, "history": self.grid_history, "flux": self.flux}
+        for name, array in arrays.items():
+            tmp = os.path.join(path, name + ".tmp.npy")
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=array.dtype,
+                                            shape=array.shape)
+            out[...] = array
+            out.flush()
+            del out
+        for name in arrays:
+            os.replace(os.path.join(path, name + ".tmp.npy"), os.path.join(path, name + ".npy"))
+
+        kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state = {
+            "n": self.n, "m": self.m, "random_state": self.random_state,
+            "engine": self.engine, "erosion_rate": self.erosion_rate,
+            "deposition": self.deposition, "erosion_interval": self.erosion_interval,
+            "checkpoint_interval": self.checkpoint_interval,
+            "memory": self.memory,
+            "step_count": self.step_count,
+            "rng": [kind, keys.tolist(), pos, has_gauss, cached_gaussian],
+        }
+        tmp = os.path.join(path, "state.tmp.json")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(path, "state.json"))
+
+    @classmethod
+    def from_checkpoint(cls, path, checkpoint_dir=None):
+        """
+        Resume a run from a checkpoint. The arrays are memory-mapped copy-on-write, so
+        only the parts the run touches are read into memory and the checkpoint files are
+        not modified. The global random state is restored, so the resumed run continues
+        like the original one. The event engine rebuilds its queue from the grid, so
+        it may relax cells of equal priority in a different order.
+
+        Args:
+            path (str): checkpoint directory
+            checkpoint_dir (str): where the resumed run saves its checkpoints, defaults
+                to path
+        """
+        state, arrays = load_checkpoint(path, mmap_mode="c")
+        sim = cls(
+            n=state["n"], m=state["m"], random_state=state["random_state"],
+            engine=state["engine"], erosion_rate=state["erosion_rate"],
+            deposition=state["deposition"], erosion_interval=state["erosion_interval"],
+            checkpoint_dir=path if checkpoint_dir is None else checkpoint_dir,
+            checkpoint_interval=state["checkpoint_interval"],
+            memory=state.get("memory", "default"),
+        )
+        sim.grid = arrays["grid"]
+        sim.grid_history = arrays["history"]
+        sim.flux = arrays["flux"]
+        sim.step_count = state["step_count"]
+        kind, keys, pos, has_gauss, cached_gaussian = state["rng"]
+        np.random.set_state((kind, np.array(keys, dtype=np.uint32), pos, has_gauss,
+                             cached_gaussian))
+        return sim
 
     def run(self, n_steps=100):
         """
         Run the river evolution simulation for n_steps
         """
-        orig_map=plt.cm.get_cmap('Blues')
-  
-# reversing the original colormap using reversed() function
-        reversed_map = orig_map.reversed()
+        if self.engine == "event":
+            return self._run_events(n_steps)
+        if self.engine == "synchronous":
+            # scratch arrays of _evolve_synchronous, reused every step
+            self._buffers = [np.empty((self.n+1, self.m), dtype=self.grid.dtype)] + [
+                np.empty((self.n, self.m), dtype=self.grid.dtype) for k in range(4)
+            ]
+            for i in range(n_steps):
+                if np.random.rand() < 0.5:
+                    self._percipate()
+                self._evolve_synchronous()
+                self.grid_history[1, ...] += self.grid[1, ...]
+                self._end_step()
+            return self.grid[1]
+
         for i in range(n_steps):
             t = np.random.rand()
             if t < 0.5:
                 self._percipate()
             # print(self.grid)
-            self.grid_history[1, ...] += self.grid[1, ...]
             self._evolve()
             self.grid_history[1, ...] += self.grid[1, ...]
+            self._end_step()
             # plt.imshow(self.grid[1, :-1, :], cmap = 'Blues')
             # plt.figure()
             # plt.imshow(self.grid_history[1, ...])
@@ -98,7 +459,27 @@ class River_Evolution:
 
         return self.grid[1]
 
+def load_checkpoint(path, mmap_mode="r"):
+    """
+    Open a checkpoint written by River_Evolution.checkpoint without reading the
+    arrays into memory.
+
+    Returns:
+        state (dict): parameters, step count and random state
+        arrays (dict): memory-mapped "grid", "history" and "flux" arrays
+    """
+    with open(os.path.join(path, "state.json")) as f:
+        state = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        for name in ("grid", "history", "flux")
+    }
+    return state, arrays
+
+
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     # Create a simulation object
     sim = River_Evolution(20, 50)
     # Run the simulation